@@ -1,29 +1,60 @@
-from collections import defaultdict
+import os
+import json
 import dash
 import dash_table
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
 import plotly.express as px
 import datetime
 import numpy as np
 import dash_ui as dui
 import logging
+import functools
+import flask
+import plotly
 from datetime import datetime
 from inspect import currentframe, getframeinfo
 
 
 from data import (
-    DATA_SOURCE,
-    get_resources,
-    get_df,
-    df_from_path
+    DATA_SOURCE
+)
+
+from dataset import (
+    current_dataset,
+    swap_dataset,
+    load_dataset
+)
+
+from refresh import (
+    start_refresher
+)
+
+from figcache import (
+    FigureCache,
+    cached_figure
+)
+
+from metrics import (
+    instrument
+)
+
+from responses import (
+    ResponseCache
 )
 
 from helpers import (
-    filter_df,
-    xth_date
+    date_slice,
+    latest_date,
+    latest_by_location,
+    location_matrix,
+    TableIndex,
+    decimate,
+    max_points_for_width,
+    zoom_range
 )
 
 # Define stylesheets to be used
@@ -40,6 +71,26 @@ RECOVERED_COLOUR = 'rgba(52, 189, 45, 0.8)'
 DEATHS_COLOUR = 'rgba(255, 102, 102, 0.8)'
 FONT = "Courier New, monospace"
 
+# How each metric is shown on the maps: the word in hover labels, the marker
+# colour and how much marker sizes are scaled down by
+MAP_METRICS = {
+    "Confirmed": ("confirmed", CONFIRMED_COLOUR, 50),
+    "Deaths": ("dead", DEATHS_COLOUR, 50),
+    "Recovered": ("recovered", RECOVERED_COLOUR, 10),
+}
+
+MAP_MODES = [
+    {'label': "Latest", 'value': "latest"},
+    {'label': "Time-lapse", 'value': "timelapse"},
+]
+
+# The metrics the comparable time series can show
+PLOT_OPTIONS = [
+    {'label': "Cases", 'value': "Confirmed"},
+    # {'label': "Recoveries", 'value': "Recovered"},
+    {'label': "Deaths", 'value': "Deaths"},
+]
+
 TOOLBAR_BUTTONS = [
   "zoom2d", "pan2d", "select2d", "lasso2d", "zoomIn2d", "zoomOut2d", "autoScale2d", "resetScale2d",
   "hoverClosestCartesian", "hoverCompareCartesian",
@@ -70,51 +121,8 @@ MINIMALIST_CONFIG ={
     "modeBarButtonsToRemove": CHOSEN_BUTTONS,
 }
 
-# if we currently have no resources, get them
-try:
-    resources
-    current_api
-except NameError:
-    resources, current_api = get_resources(DATA_SOURCE)
-
-try:
-    headline_df
-except NameError:
-    headline_df = df_from_path(resources['worldwide-aggregate'])
-
-try:
-    ts_df
-except NameError:
-    ts_df = df_from_path(resources['countries-aggregated'])
-
-try:
-    df2
-except NameError:
-    df2 = get_df(current_api)
-
-try:
-    ref_table
-except NameError:
-    ref_table = df_from_path(resources['reference'])
-
-# print(ref_table)
-
-# Current day figures
-current_date = headline_df.iloc[len(headline_df)-1][0]
-current_confirmed = headline_df.iloc[len(headline_df)-1][1]
-current_recovered = headline_df.iloc[len(headline_df)-1][2]
-current_deaths = headline_df.iloc[len(headline_df)-1][3]
-
-# Previous day figures
-prev_date = headline_df.iloc[len(headline_df)-2][0]
-prev_confirmed = headline_df.iloc[len(headline_df)-2][1]
-prev_recovered = headline_df.iloc[len(headline_df)-2][2]
-prev_deaths = headline_df.iloc[len(headline_df)-2][3]
-
-# Growth rates
-confirmed_growth = (current_confirmed/prev_confirmed) - 1
-recovered_growth = (current_recovered/prev_recovered) - 1
-deaths_growth = (current_deaths/prev_deaths) - 1
+figure_cache = FigureCache()
+figure_responses = ResponseCache()
 
 
 # Formatted growth rates
@@ -126,39 +134,17 @@ def formatted_mvmt(figure, text):
     text += f" {figure:,.1%})"
     return text
 
-confirmed_growth_text = formatted_mvmt(confirmed_growth, "")
-recovered_growth_text = formatted_mvmt(recovered_growth, "")
-deaths_growth_text = formatted_mvmt(deaths_growth, "")
-
 
 # Set up the app / server
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
 server = app.server
-
-# Define the grid 
-grid = dui.Grid(_id="grid", num_rows=12, num_cols=12, grid_padding=2)
-
-# Define the layout
-app.layout = html.Div(
-    dui.Layout(
-        grid=grid,
-    ),
-    style={
-        'height': '100vh',
-        'width': '100vw'
-    }
-)
+instrument(server)
 
 app.config.suppress_callback_exceptions = True
 
-# Create a world map and plot cases, recoveries and/or deaths
-def generate_map_w_options(df, ref, plot_cases=True, plot_recoveries=True, plot_deaths=True):
-    latest_date = df.iloc[len(df)-1][2]
-    df = filter_df(df,"Date",latest_date)
-    plotted = defaultdict(lambda: False)
-    # print(df2)
-    fig = go.Figure(go.Scattergeo())
+# Apply the look shared by all the world maps
+def style_map(fig, titletext):
     fig.update_geos(
         projection_type="natural earth",
         showcountries=True,
@@ -167,16 +153,7 @@ def generate_map_w_options(df, ref, plot_cases=True, plot_recoveries=True, plot_
         countrywidth=0.5,
         coastlinewidth=0.8,
         )
-    
-    titletext = "<b>Confirmed"
-    if plot_cases:
-        titletext += " cases"
-    if plot_recoveries:
-        titletext += " recoveries"
-    if plot_deaths:
-        titletext += " deaths"
-    titletext += "</b>"
-    
+
     fig.update_layout(
         title={
             'text': titletext,
@@ -193,166 +170,147 @@ def generate_map_w_options(df, ref, plot_cases=True, plot_recoveries=True, plot_
         ),
         )
 
-    for location in range((len(df))):
-        
-        location_name = df.iloc[location][1]
-        fdf = filter_df(df, "Country/Region", location_name)
-        # TODO: refactor these 3 ifs to reduce repeated code
-
-        if plot_cases and not plotted[f"c_{location_name}"]:
-            try:
-                # Plot confirmed cases in each area
-                confirmed = fdf['Confirmed'].sum()
-                # print(f"Total cases for {location_name} = {confirmed}")
-                if confirmed <= 0:
-                    continue
-                loc_details = ref.loc[ref['Combined_Key'] == location_name] 
-                lon = [loc_details.iloc[0][9]]
-                lat = [loc_details.iloc[0][8]]
-                fig.add_trace(go.Scattergeo(
-                    lon=lon,
-                    lat=lat,
-                    text=f"{location_name}: {confirmed:,.0f} confirmed",
-                    name=location_name + " - confirmed",
-                    marker=dict(
-                        size=int(confirmed**(0.5))/50,
-                        color=CONFIRMED_COLOUR,
-                        line_color='rgba(0,0,0,0.35)',
-                        line_width=0.5,
-                    )
-                ))
-                plotted[f"c_{location_name}"] = True
-            except Exception as e:
-                pass
-
-        if plot_deaths and not plotted[f"d_{location_name}"]:
-            try:
-                # Plot deaths in each area
-                deaths = fdf['Deaths'].sum()
-                # deaths = 0 if np.isnan(df.iloc[location][3]) else df.iloc[location][3]
-                if deaths <= 0:
-                    continue
-                loc_details = ref.loc[ref['Combined_Key'] == location_name] 
-                lon = [loc_details.iloc[0][9]]
-                lat = [loc_details.iloc[0][8]]
-                fig.add_trace(go.Scattergeo(
-                    lon=lon,
-                    lat=lat,
-                    text=f"{location_name}: {deaths:,.0f} dead",
-                    name=location_name + " - deaths",
-                    marker=dict(
-                        size=int(deaths**(0.5))/50,
-                        color=DEATHS_COLOUR,
-                        line_color='rgba(0,0,0,0.35)',
-                        line_width=0.5,
-                    )
-                ))
-                plotted[f"d_{location_name}"] = True
-            except Exception as e:
-                pass
-
-        if plot_recoveries and not plotted[f"r_{location_name}"]:
-            try:
-                # Plot recoveries in each area
-                recoveries = 0 if np.isnan(df.iloc[location][7]) else df.iloc[location][7]
-                if recoveries <= 0:
-                    continue
-                fig.add_trace(go.Scattergeo(
-                    lon=[float(df.iloc[location][5])],
-                    lat=[df.iloc[location][4]],
-                    text=f"{location_name}: {recoveries:,.0f} recovered",
-                    name=location_name + " - recoveries",
-                    marker=dict(
-                        size=int(recoveries**(0.5))/10,
-                        color=RECOVERED_COLOUR,
-                        line_color='rgba(0,0,0,0.35)',
-                        line_width=0.5,
-                    )
-                ))
-                plotted[f"r_{location_name}"] = True
-            except Exception as e:
-                pass
+
+# Create a world map and plot cases, recoveries and/or deaths
+def generate_map_w_options(df, ref, plot_cases=True, plot_recoveries=True, plot_deaths=True):
+    fig = go.Figure(go.Scattergeo())
+    
+    titletext = "<b>Confirmed"
+    if plot_cases:
+        titletext += " cases"
+    if plot_recoveries:
+        titletext += " recoveries"
+    if plot_deaths:
+        titletext += " deaths"
+    titletext += "</b>"
+    
+    style_map(fig, titletext)
+
+    locations = latest_by_location(df, ref)
+
+    for plot, column in [
+        (plot_cases, "Confirmed"),
+        (plot_deaths, "Deaths"),
+        (plot_recoveries, "Recovered"),
+    ]:
+        if not plot:
+            continue
+        word, colour, scale = MAP_METRICS[column]
+
+        # One trace per metric, with a marker for every location that has any
+        shown = locations[locations[column] > 0]
+        fig.add_trace(go.Scattergeo(
+            lon=shown["Long_"],
+            lat=shown["Lat"],
+            text=shown.index + ": " + shown[column].map("{:,.0f}".format) + f" {word}",
+            hoverinfo="text",
+            name=column,
+            marker=dict(
+                size=np.sqrt(shown[column]).astype(int) / scale,
+                color=colour,
+                line_color='rgba(0,0,0,0.35)',
+                line_width=0.5,
+            )
+        ))
 
     return fig
 
 
+# A world map of one metric that plays day by day, with a date slider.
+# The (date x location) matrix is built in one pivot and every frame only
+# carries the marker sizes and values for its date; everything else is set
+# once on the base trace.
+def generate_map_timelapse(df, ref, plot="Confirmed"):
+    word, colour, scale = MAP_METRICS[plot]
+    matrix, coords = location_matrix(df, ref, plot)
+
+    values = np.nan_to_num(matrix.to_numpy(dtype=float)).clip(0)
+    sizes = np.round(np.floor(np.sqrt(values)) / scale, 2)
+    dates = matrix.index.strftime("%Y-%m-%d").tolist()
+
+    fig = go.Figure(go.Scattergeo(
+        lon=coords["Long_"],
+        lat=coords["Lat"],
+        text=matrix.columns,
+        customdata=values[-1],
+        hovertemplate=f"%{{text}}: %{{customdata:,.0f}} {word}<extra></extra>",
+        name=plot,
+        marker=dict(
+            size=sizes[-1],
+            color=colour,
+            line_color='rgba(0,0,0,0.35)',
+            line_width=0.5,
+        )
+    ))
+    style_map(fig, f"<b>Confirmed {'cases' if plot == 'Confirmed' else plot.lower()} over time</b>")
+
+    # Frames and slider steps are plain dicts, there are hundreds of them
+    figure = fig.to_plotly_json()
+    figure["frames"] = [
+        {"name": date, "traces": [0], "data": [{"customdata": values[i].tolist(), "marker": {"size": sizes[i].tolist()}}]}
+        for i, date in enumerate(dates)
+    ]
+    figure["layout"]["sliders"] = [{
+        "active": len(dates) - 1,
+        "currentvalue": {"prefix": "Date: "},
+        "pad": {"t": 0, "b": 5},
+        "steps": [
+            {
+                "label": date,
+                "method": "animate",
+                "args": [[date], {"mode": "immediate", "frame": {"duration": 0, "redraw": True}, "transition": {"duration": 0}}],
+            }
+            for date in dates
+        ],
+    }]
+    figure["layout"]["updatemenus"] = [{
+        "type": "buttons",
+        "showactive": False,
+        "x": 0,
+        "y": 0,
+        "xanchor": "right",
+        "yanchor": "top",
+        "buttons": [
+            {"label": "Play", "method": "animate", "args": [None, {"fromcurrent": True, "frame": {"duration": 150, "redraw": True}, "transition": {"duration": 0}}]},
+            {"label": "Pause", "method": "animate", "args": [[None], {"mode": "immediate", "frame": {"duration": 0, "redraw": False}}]},
+        ],
+    }]
+    return figure
+
+
 # Plot death rate bar chart by country level
 def generate_deathrates_by_country(
-    resources=resources, max_rows=30, min_cases=15000, min_deaths=525,
-    date=False):
-    df = ts_df
-
-    # If no date is given, take the latest
-    if not date:
-        date = df.iloc[len(df)-1,0] 
-    df = filter_df(df, "Date", date)
-    
-    # Set up for the data
-    x_data = []
-    y_data = []
-    y_label = []
-
-    # Gather the data from the dataframe
-    for location in range((len(df))):            
-        location_name = df.iloc[location][1]
-
-        cases = df.iloc[location][2]
-        if cases == 0:
-            cases+=1
-        deaths = df.iloc[location][4]
-
-        if cases > min_cases and deaths > min_deaths:
-            death_rate = deaths/cases
-            x_data.append(death_rate)
-            y_data.append(location_name)
-            y_label.append(f"{death_rate*100:.1f}% ({deaths:,}/{cases:,})")
-
-    num_rows = min(max_rows, len(x_data))
-
-    # Get a list of colours that change as you change values being plotted
-    colours = []
-    for row in range(num_rows):
-        # colours.append(f'rgb(255,{194/num_rows*(num_rows-row)+92},{153/num_rows*(num_rows-row)+20})')
-        colours.append(f'rgb(255,{230-128*(row/num_rows)},{230-128*(row/num_rows)})')
-
-    # RECOVERED_COLOUR = 'rgba(52, 189, 45, 0.8)'
-    # DEATHS_COLOUR = 'rgba(255, 102, 102, 0.8)'
-
-    # Sum the total cases & total deaths, calc avg death rate
-    total_cases = df.sum(axis=0)[2]
-    total_deaths = df.sum(axis=0)[4]
-    average_death_rate = total_deaths / total_cases
-
-    # Add avg death rate to dataset
-    x_data.append(average_death_rate)
-    y_data.append("Average")
-    y_label.append(f"{average_death_rate*100:.1f}% ({total_deaths:,}/{total_cases:,})")
-
-    # Sort the axes
-    x_data, y_data, y_label = (list(t) for t in zip(*sorted(zip(x_data, y_data, y_label))))
-
-    # Trim data to the amount of max_rows specified
-    x_data = x_data[len(x_data)-max_rows:len(x_data)]
-    y_data = y_data[len(y_data)-max_rows:len(y_data)]
-    y_label = y_label[len(y_label)-max_rows:len(y_label)]
-
-    # Change the colour of the average item
-    try:
-        colours[y_data.index('Average')] = 'rgba(168, 102, 255, 0.8)'
-    except Exception as e:
-        print(f"Average not in top {num_rows}")
+    max_rows=30, min_cases=15000, min_deaths=525,
+    date=False, ranking=None):
+    if ranking is None:
+        ranking = current_dataset().death_rates
+
+    # Countries above the thresholds plus the average, highest death rate first
+    ranked = ranking.rank(date, min_cases, min_deaths, max_rows)
+    x_data = ranked["Rate"]
+    y_data = ranked["Country"]
+    y_label = [
+        f"{rate*100:.1f}% ({deaths:,}/{cases:,})"
+        for rate, deaths, cases in zip(ranked["Rate"], ranked["Deaths"], ranked["Cases"])
+    ]
+
+    # Colours get darker as the death rate goes up, the average stands out
+    num_rows = len(ranked)
+    shades = 230 - 128 * (np.arange(num_rows)[::-1] / max(num_rows, 1))
+    colours = np.array([f'rgb(255,{shade},{shade})' for shade in shades], dtype=object)
+    colours[(y_data == ranking.AVERAGE).values] = 'rgba(168, 102, 255, 0.8)'
 
     # Plot the graph
     fig = go.Figure()
     fig.add_trace(go.Bar(
-        x=y_data[::-1],
-        y=x_data[::-1],
-        text=y_label[::-1],
+        x=y_data,
+        y=x_data,
+        text=y_label,
         # textposition="outside",
         name="Death rate summary",
         orientation='v',
         marker=dict(
-            color=colours[::-1],
+            color=colours,
             line=dict(
                 color='rgba(38, 24, 74, 0.8)',
                 width=1)
@@ -387,25 +345,30 @@ def generate_deathrates_by_country(
 
 
 # Time series graph with lines for confirmed, recovered and deaths
-def generate_world_ts_options(resources=resources, plot_confirmed=True, plot_recovered=True, plot_deaths=True):
-    df = headline_df
-    
+# Each trace is cut down to max_points points within x_range (see helpers.decimate)
+def generate_world_ts_options(plot_confirmed=True, plot_recovered=True, plot_deaths=True, df=None,
+                              max_points=None, x_range=None):
+    if df is None:
+        df = current_dataset().headline_df
+
     # Add data
-    date = df['Date'].tolist()
-    confirmed = df['Confirmed'].tolist()
-    recovered = df['Recovered'].tolist()
-    deaths = df['Deaths'].tolist()
+    def points(column):
+        rows = decimate(df['Date'].values, df[column].values, max_points, x_range)
+        return df['Date'].iloc[rows].tolist(), df[column].iloc[rows].tolist()
 
     fig = go.Figure()
 
     # Create and style traces
     if plot_confirmed:
+        date, confirmed = points('Confirmed')
         fig.add_trace(go.Scatter(x=date, y=confirmed, name='Cases',
                                 line=dict(color=CONFIRMED_COLOUR, width=2)))
     if plot_recovered:
+        date, recovered = points('Recovered')
         fig.add_trace(go.Scatter(x=date, y=recovered, name = 'Recoveries',
                                 line=dict(color=RECOVERED_COLOUR, width=2)))
     if plot_deaths:
+        date, deaths = points('Deaths')
         fig.add_trace(go.Scatter(x=date, y=deaths, name='Deaths',
                                 line=dict(color=DEATHS_COLOUR, width=2)))
 
@@ -424,7 +387,9 @@ def generate_world_ts_options(resources=resources, plot_confirmed=True, plot_rec
         ),
         xaxis_title='Date',
         yaxis_title='Confirmed numbers',
-        hovermode='x')
+        hovermode='x',
+        # Keep the user's zoom when the zoomed-in points arrive
+        uirevision='world-time-series')
 
     fig.update_yaxes(nticks=10)
     fig.update_xaxes(nticks=10)
@@ -432,24 +397,34 @@ def generate_world_ts_options(resources=resources, plot_confirmed=True, plot_rec
     return fig
 
 
+# The countries compared until the user picks their own
+COMPARABLE_COUNTRIES = [
+    "China", "United Kingdom", "Italy", "Spain", "Iran", "US",
+    "Vietnam", "New Zealand", "Mexico"
+]
+
+
 # Create a time series for different countries where we have "day 0" etc. 
 # instead of actual dates - this is better for comparability
-@app.callback(
-    Output('comp-output', 'figure'),
-    [Input(component_id='plot', component_property='value')]
-)
+@cached_figure(figure_cache, lambda: current_dataset().version)
 def generate_comparable_time_series(
         plot="Confirmed",
-        countries=[
-            "China", "United Kingdom", "Italy", "Spain", "Iran", "US",
-            "Vietnam", "New Zealand", "Mexico"
-        ],
-        df=ts_df,
+        countries=COMPARABLE_COUNTRIES,
+        aligned=None,
         xth=1,
-        ref_table=ref_table,
-        per_x_people=100000
+        reference=None,
+        per_x_people=100000,
+        max_points=None,
+        x_range=None
         ):
 
+    # Take everything from the same dataset, even if a refresh swaps it meanwhile
+    data = current_dataset()
+    if aligned is None:
+        aligned = data.aligned
+    if reference is None:
+        reference = data.reference
+
     fig = go.Figure()
 
     if plot == "Confirmed":
@@ -464,24 +439,17 @@ def generate_comparable_time_series(
     else:
         raise ValueError(f"'plot' variable must be equal to 'Confirmed', 'Recovered' or 'Deaths'. Your input was '{plot}'")
 
-    for country in countries:
-
-        base_date = xth_date(df, country, xth, data=plural_plot_word)
-        fdf = filter_df(ref_table, "Combined_Key", country)
-        popn = int(fdf["Population"])
-
-        # Filter the dataframe for country and date of xth case
-        country_df = df.loc[df["Country"] == country]
-        try:
-            country_df = country_df[country_df['Date'] >= base_date]
-        except Exception as e:
+    # Each country's numbers from the date of the xth case
+    for country, values in aligned.gather(countries, plot, xth):
+        popn = reference.population_of(country)
+        if popn is None:
             continue
 
-        x_axis_data = []
-        y_axis_data = country_df[plot].div(popn).mul(per_x_people).tolist()
-
-        for i in range(len(y_axis_data)):
-            x_axis_data.append(i)
+        y_values = values / popn * per_x_people
+        days = np.arange(len(y_values))
+        rows = decimate(days, y_values, max_points, x_range)
+        x_axis_data = days[rows].tolist()
+        y_axis_data = y_values[rows].tolist()
 
         fig.add_trace(go.Scatter(x=x_axis_data, y=y_axis_data, name=country, mode='lines'))
 
@@ -501,7 +469,9 @@ def generate_comparable_time_series(
         ),
         xaxis_title=f'Days since {xth}st {plot_word}',
         yaxis_title=f'Confirmed {plural_plot_word} per {per_x_people} people',
-        hovermode='x')
+        hovermode='x',
+        # Keep the user's zoom when the zoomed-in points arrive, until the metric changes
+        uirevision=plot)
 
     fig.update_yaxes(nticks=10)
     fig.update_xaxes(nticks=10)
@@ -509,175 +479,458 @@ def generate_comparable_time_series(
     return fig
 
 
+TABLE_COLUMNS = ['Country', 'Confirmed', 'Recovered', 'Deaths']
+TABLE_PAGE_SIZE = 10
+
+
 # Generate a table displaying all headline information by country
-def generate_datatable(df=ts_df,date=False):
+def generate_datatable(df=None,date=False):
+    if df is None:
+        df = current_dataset().ts_df
 
     # If no date is given, take the latest
     if not date:
-        date = df.iloc[len(df)-1,0] 
-    df = filter_df(df, "Date", date)
+        date = latest_date(df)
+    df = date_slice(df, date)
 
     # Filter out the date column
-    df = df[['Country', 'Confirmed', 'Recovered', 'Deaths']]
+    df = df[TABLE_COLUMNS].copy()
 
-    for i in range(len(df)):
-        if len(df.iloc[i][0]) > 15:
-            df.at[df.iloc[i].name, 'Country'] = f"{df.iloc[i][0][:12]}..."
+    # Shorten long names
+    names = df['Country'].astype(str)
+    df['Country'] = names.where(names.str.len() <= 15, names.str[:12] + "...")
     
     return df
 
 
-grid.add_element(col=1, row=1, width=6, height=4, element=dcc.Graph(
-    id='World map of confirmed cases',
-    config=MINIMALIST_CONFIG,
-    figure=generate_map_w_options(df2, ref_table, plot_recoveries=False, plot_deaths=False),
-    style={"height": "100%", "width": "100%"}
-))
+# A world map with a choice between the latest numbers and a time-lapse
+def map_panel(graph_id, mode_id):
+    return html.Div([
+        dcc.RadioItems(
+            id=mode_id,
+            options=MAP_MODES,
+            value="latest",
+            labelStyle={
+                "display": "inline-block",
+                },
+            style={
+                "height": "8%",
+                "font-family": FONT,
+                "text-align":"center",
+                "background-color": "white",
+            }),
+        dcc.Graph(
+            id=graph_id,
+            config=MINIMALIST_CONFIG,
+            style={"height": "92%", "width": "100%"}
+            )
+        ],
+        style={"height": "100%", "width": "100%"},
+    )
 
 
-# grid.add_element(col=5, row=1, width=4, height=4, element=dcc.Graph(
-#     id='World map of confirmed recoveries',
-#     config=MINIMALIST_CONFIG,
-#     figure=generate_map_w_options(df2, ref_table, plot_cases=False, plot_deaths=False),
-#     style={"height": "100%", "width": "100%"}
-# ))
+# Build the page for one dataset
+def build_layout(data):
 
+    confirmed_growth_text = formatted_mvmt(data.confirmed_growth, "")
+    recovered_growth_text = formatted_mvmt(data.recovered_growth, "")
+    deaths_growth_text = formatted_mvmt(data.deaths_growth, "")
 
-grid.add_element(col=7, row=1, width=6, height=4, element=dcc.Graph(
-    id='World map of confirmed deaths',
-    config=MINIMALIST_CONFIG,
-    figure=generate_map_w_options(df2, ref_table, plot_cases=False, plot_recoveries=False),
-    style={"height": "100%", "width": "100%"}
-))
+    # Define the grid 
+    grid = dui.Grid(_id="grid", num_rows=12, num_cols=12, grid_padding=2)
 
+    grid.add_element(col=1, row=1, width=6, height=4, element=map_panel('World map of confirmed cases', 'cases-map-mode'))
 
-df_datatable = generate_datatable()
 
+    # grid.add_element(col=5, row=1, width=4, height=4, element=dcc.Graph(
+    #     id='World map of confirmed recoveries',
+    #     config=MINIMALIST_CONFIG,
+    #     figure=generate_map_w_options(data.df2, data.ref_table, plot_cases=False, plot_deaths=False),
+    #     style={"height": "100%", "width": "100%"}
+    # ))
 
-grid.add_element(col=1, row=5, width=4, height=4, element=dash_table.DataTable(
-    id="Table",
-    columns=[{"name": i, "id": i} for i in df_datatable.columns],
-    data=df_datatable.to_dict('records'),
-    sort_action="native",
-    sort_by=[{"column_id": "Confirmed", "direction": "desc"}],
-))
 
+    grid.add_element(col=7, row=1, width=6, height=4, element=map_panel('World map of confirmed deaths', 'deaths-map-mode'))
 
-grid.add_element(col=5, row=5, width=4, height=4, element=html.Div(
-    [
-        html.H4(
-            ["Covid-19 dashboard"],
-            style={"font-weight": "bold"}
-        ),
-        html.P(
-            ["Worldwide headline figures:"],
-            style={"font-weight": "bold"}
-        ),
-        html.Div([
+
+    grid.add_element(col=1, row=5, width=4, height=4, element=dash_table.DataTable(
+        id="Table",
+        columns=[
+            {"name": i, "id": i, "type": "text" if i == "Country" else "numeric"}
+            for i in TABLE_COLUMNS
+        ],
+        page_action="custom",
+        page_current=0,
+        page_size=TABLE_PAGE_SIZE,
+        sort_action="custom",
+        sort_mode="single",
+        sort_by=[{"column_id": "Confirmed", "direction": "desc"}],
+        filter_action="custom",
+        filter_query="",
+    ))
+
+
+    grid.add_element(col=5, row=5, width=4, height=4, element=html.Div(
+        [
+            html.H4(
+                ["Covid-19 dashboard"],
+                style={"font-weight": "bold"}
+            ),
+            html.P(
+                ["Worldwide headline figures:"],
+                style={"font-weight": "bold"}
+            ),
             html.Div([
-                html.H5(
-                    [f"Cases: {current_confirmed:,}"],
-                    style={"color": CONFIRMED_COLOUR, "font-weight": "bold", "display": "inline"}
-                ),
+                html.Div([
+                    html.H5(
+                        [f"Cases: {data.current_confirmed:,}"],
+                        style={"color": CONFIRMED_COLOUR, "font-weight": "bold", "display": "inline"}
+                    ),
+                    html.P(
+                        [f" {confirmed_growth_text}"],
+                        style={"font-size": "1.2rem", "display": "inline"}
+                    )
+                ]),
+                html.Div([
+                    html.H5(
+                        [f"Recoveries: {data.current_recovered:,}"],
+                        style={"color": RECOVERED_COLOUR, "font-weight": "bold", "display": "inline"}
+                    ),
+                    html.P(
+                        [f" {recovered_growth_text}"],
+                        style={"font-size": "1.2rem", "display": "inline"}
+                    )
+                ]),
+                html.Div([
+                    html.H5(
+                        [f"Deaths: {data.current_deaths:,}"],
+                        style={"color": DEATHS_COLOUR, "font-weight": "bold", "display": "inline"}
+                    ),
+                    html.P(
+                        [f" {deaths_growth_text}"],
+                        style={"font-size": "1.2rem", "display": "inline"}
+                    )
+                ]),
                 html.P(
-                    [f" {confirmed_growth_text}"],
-                    style={"font-size": "1.2rem", "display": "inline"}
-                )
-            ]),
-            html.Div([
-                html.H5(
-                    [f"Recoveries: {current_recovered:,}"],
-                    style={"color": RECOVERED_COLOUR, "font-weight": "bold", "display": "inline"}
+                    [f"Data accurate as at {data.current_date:%Y-%m-%d}"],
+                    style={"margin-top": "0.75em"}
                 ),
                 html.P(
-                    [f" {recovered_growth_text}"],
-                    style={"font-size": "1.2rem", "display": "inline"}
-                )
-            ]),
-            html.Div([
-                html.H5(
-                    [f"Deaths: {current_deaths:,}"],
-                    style={"color": DEATHS_COLOUR, "font-weight": "bold", "display": "inline"}
+                    ["Created by Christian Kneller"]
                 ),
                 html.P(
-                    [f" {deaths_growth_text}"],
-                    style={"font-size": "1.2rem", "display": "inline"}
+                    [
+                        "Source code available at ",
+                        html.A("github", href="https://github.com/ChrisKneller/covid-dashboard/", target="_blank")
+                    ]
                 )
-            ]),
-            html.P(
-                [f"Data accurate as at {current_date}"],
-                style={"margin-top": "0.75em"}
-            ),
-            html.P(
-                ["Created by Christian Kneller"]
-            ),
-            html.P(
-                [
-                    "Source code available at ",
-                    html.A("github", href="https://github.com/ChrisKneller/covid-dashboard/", target="_blank")
-                ]
-            )
 
-        ]),
-        # style={"font-size": "1rem"})
-    ],
-    style={
-        "font-family": FONT, 
-        "text-align":"center", 
-        "background-color": "white", 
-        "height": "100%",
-        "display": "flow-root"},
-))
-
-
-grid.add_element(col=9, row=5, width=4, height=4, element=html.Div([
-    dcc.RadioItems(
-        id="plot", 
-        options=[
-            {'label': "Cases", 'value': "Confirmed"},
-            # {'label': "Recoveries", 'value': "Recovered"},
-            {'label': "Deaths", 'value': "Deaths"},
+            ]),
+            # style={"font-size": "1rem"})
         ],
-        value="Confirmed",
-        labelStyle={
-            "display": "inline-block",
-            },
         style={
-            "height": "10%",  
             "font-family": FONT, 
             "text-align":"center", 
-            "background-color": "white",
-        }),
-    dcc.Graph(
-        id="comp-output",
+            "background-color": "white", 
+            "height": "100%",
+            "display": "flow-root"},
+    ))
+
+
+    grid.add_element(col=9, row=5, width=4, height=4, element=html.Div([
+        dcc.RadioItems(
+            id="plot", 
+            options=PLOT_OPTIONS,
+            value="Confirmed",
+            labelStyle={
+                "display": "inline-block",
+                },
+            style={
+                "height": "10%",  
+                "font-family": FONT, 
+                "text-align":"center", 
+                "background-color": "white",
+            }),
+        dcc.Dropdown(
+            id="countries",
+            options=[{'label': country, 'value': country} for country in data.aligned.countries],
+            value=COMPARABLE_COUNTRIES,
+            multi=True,
+            placeholder="Countries to compare",
+            style={
+                "max-height": "15%",
+                "overflow-y": "auto",
+                "font-family": FONT,
+                "font-size": "1rem",
+            }),
+        dcc.Graph(
+            id="comp-output",
+            config=MINIMALIST_CONFIG,
+            style={"height": "75%", "width": "100%"}
+            )
+        ],
+        style={"height": "100%", "width": "100%"},
+    ))
+
+
+    # grid.add_element(col=7, row=5, width=6, height=4, element=dcc.Graph(
+    #     id="Comparable time series",
+    #     config=MINIMALIST_CONFIG,
+    #     figure=generate_comparable_time_series(xth=1000, plot="Confirmed"),
+    #     style={"height": "100%", "width": "100%"}
+    # ))
+
+    grid.add_element(col=1, row=9, width=6, height=4, element=dcc.Graph(
+        id="Overall time series",
+        config=MINIMALIST_CONFIG,
+        style={"height": "100%", "width": "100%"}
+    ))
+
+    grid.add_element(col=7, row=9, width=6, height=4, element=dcc.Graph(
+        id="Death rates",
         config=MINIMALIST_CONFIG,
-        style={"height": "90%", "width": "100%"}
+        style={"height": "100%", "width": "100%",}
+    ))
+
+    # Define the layout
+    return html.Div(
+        [
+            dui.Layout(
+                grid=grid,
+            ),
+            # Triggers the callbacks that fill in the panels on page load
+            html.Div(id="page-load", style={"display": "none"}),
+            # The browser's window width, which decides how many points the time series get
+            dcc.Store(id="viewport"),
+        ],
+        style={
+            'height': '100vh',
+            'width': '100vw'
+        }
+    )
+
+
+# The heavy panels are left empty in the layout and filled in by these callbacks
+# when a page is first loaded. Each result is cached for the data version, so
+# a panel is only worked out once it's actually viewed, and then only once.
+# Panels that only depend on the data and their inputs, by callback output
+static_panels = {}
+
+
+def lazy_panel(component_id, component_property, inputs=None, normalize=None):
+    # normalize, if given, turns the callback's input values into the
+    # arguments func is called and cached with, so inputs that make the same
+    # figure share a cache entry
+    def decorator(func):
+        func = cached_figure(figure_cache, lambda: current_dataset().version)(func)
+        arguments = normalize or (lambda *args: args)
+        static_panels[f"{component_id}.{component_property}"] = (func, arguments)
+
+        @functools.wraps(func)
+        def callback(*args):
+            return func(*arguments(*args))
+
+        return app.callback(
+            Output(component_id, component_property),
+            inputs or [Input("page-load", "children")]
+        )(callback)
+    return decorator
+
+
+def static_panel_response(output, values):
+    # The callback response for a static panel, serialized and compressed once
+    # per data version. values maps "id.property" of each input to its value.
+    func, arguments = static_panels[output]
+    args = list(arguments(*[values.get(f"{i['id']}.{i['property']}") for i in app.callback_map[output]["inputs"]]))
+    component_property = output.rsplit(".", 1)[1]
+    payload = figure_responses.get(
+        current_dataset().version,
+        json.dumps([output, args]),
+        lambda: json.dumps(
+            {"response": {"props": {component_property: func(*args)}}},
+            cls=plotly.utils.PlotlyJSONEncoder
         )
-    ],
-    style={"height": "100%", "width": "100%"},
-))
-
-
-# grid.add_element(col=7, row=5, width=6, height=4, element=dcc.Graph(
-#     id="Comparable time series",
-#     config=MINIMALIST_CONFIG,
-#     figure=generate_comparable_time_series(xth=1000, plot="Confirmed"),
-#     style={"height": "100%", "width": "100%"}
-# ))
-
-grid.add_element(col=1, row=9, width=6, height=4, element=dcc.Graph(
-    id="Overall time series",
-    config=MINIMALIST_CONFIG,
-    figure=generate_world_ts_options(),
-    style={"height": "100%", "width": "100%"}
-))
-
-grid.add_element(col=7, row=9, width=6, height=4, element=dcc.Graph(
-    id="Death rates",
-    config=MINIMALIST_CONFIG,
-    figure=generate_deathrates_by_country(max_rows=40),
-    style={"height": "100%", "width": "100%",}
-))
+    )
+    flask.g.serialized_bytes = len(payload.variants['identity'][0])
+    return payload.response(flask.request)
+
+
+@server.before_request
+def serve_static_panel():
+    # Answer callbacks for static panels before Dash re-serializes their figures
+    if flask.request.method != "POST" or flask.request.path != f"{app.config.routes_pathname_prefix}_dash-update-component":
+        return None
+    body = flask.request.get_json(silent=True) or {}
+    if body.get("output") not in static_panels or body.get("state"):
+        return None
+    values = {f"{i['id']}.{i['property']}": i.get("value") for i in body.get("inputs", [])}
+    return static_panel_response(body["output"], values)
+
+
+@server.route(f"{app.config.routes_pathname_prefix}_dash-figures/<output>")
+def static_panel_get(output):
+    # The same responses over GET, so browsers and CDNs can cache and revalidate
+    # them. Input values are passed as JSON in query arguments named "id.property".
+    if output not in static_panels:
+        flask.abort(404)
+    try:
+        values = {key: json.loads(value) for key, value in flask.request.args.items()}
+    except ValueError:
+        flask.abort(400)
+    return static_panel_response(output, values)
+
+
+@lazy_panel('World map of confirmed cases', 'figure', [Input('cases-map-mode', 'value')])
+def confirmed_cases_map(mode):
+    data = current_dataset()
+    if mode == "timelapse":
+        return generate_map_timelapse(data.df2, data.reference, "Confirmed")
+    return generate_map_w_options(data.df2, data.reference, plot_recoveries=False, plot_deaths=False)
+
+
+@lazy_panel('World map of confirmed deaths', 'figure', [Input('deaths-map-mode', 'value')])
+def confirmed_deaths_map(mode):
+    data = current_dataset()
+    if mode == "timelapse":
+        return generate_map_timelapse(data.df2, data.reference, "Deaths")
+    return generate_map_w_options(data.df2, data.reference, plot_cases=False, plot_recoveries=False)
+
+
+# The table only ever gets the rows on the page being looked at. Paging,
+# sorting and filtering happen here, on an index built once per data version.
+# The version and its index are swapped in as one tuple, so a request thread
+# never sees the index of another version.
+_table_index = (None, None)
+
+
+def table_index(data):
+    global _table_index
+    version, index = _table_index
+    if version != data.version:
+        index = TableIndex(generate_datatable(data.ts_df))
+        _table_index = (data.version, index)
+    return index
+
+
+@app.callback(
+    [Output('Table', 'data'), Output('Table', 'page_count')],
+    [
+        Input('Table', 'page_current'),
+        Input('Table', 'page_size'),
+        Input('Table', 'sort_by'),
+        Input('Table', 'filter_query'),
+    ]
+)
+def datatable_page(page_current, page_size, sort_by, filter_query):
+    records, page_count = table_index(current_dataset()).page(
+        page_current or 0, page_size or TABLE_PAGE_SIZE, sort_by, filter_query
+    )
+    return records, page_count
+
+
+# The time series get about a point per pixel of their width (see
+# helpers.decimate), from the window width the browser reports. Zooming in
+# fetches the zoomed window, with all the points it has room for.
+DEFAULT_VIEWPORT_WIDTH = 1280
+
+app.clientside_callback(
+    "function(_) { return window.innerWidth; }",
+    Output("viewport", "data"),
+    [Input("page-load", "children")]
+)
+
+
+def chart_points(viewport, columns):
+    # Points per trace for a chart columns wide on the 12 column grid
+    return max_points_for_width((viewport or DEFAULT_VIEWPORT_WIDTH) * columns / 12)
+
+
+def triggered_inputs():
+    # "id.property" of the inputs that changed, for the callback request being
+    # handled. Read from the request, since static panels are answered before
+    # Dash sets up dash.callback_context.
+    body = flask.request.get_json(silent=True) or {}
+    return set(body.get("changedPropIds") or [])
+
+
+def x_range_for(graph_id, relayout_data, dates=False):
+    # The x range to send a time series graph (see helpers.zoom_range). When
+    # its relayoutData is what changed, a relayout that leaves the x axis
+    # alone doesn't update the graph. When another input changed, the graph
+    # keeps the zoom it last reported, if it was one.
+    changed, x_range = zoom_range(relayout_data, dates)
+    if not changed and f"{graph_id}.relayoutData" in triggered_inputs():
+        raise PreventUpdate
+    return x_range
+
+
+def world_time_series_args(_, viewport, relayout_data):
+    return None, chart_points(viewport, 6), x_range_for('Overall time series', relayout_data, dates=True)
+
+
+@lazy_panel('Overall time series', 'figure', [
+    Input('page-load', 'children'),
+    Input('viewport', 'data'),
+    Input('Overall time series', 'relayoutData'),
+], normalize=world_time_series_args)
+def world_time_series(_, max_points, x_range):
+    return generate_world_ts_options(df=current_dataset().headline_df, max_points=max_points, x_range=x_range)
+
+
+@app.callback(
+    Output('comp-output', 'figure'),
+    [
+        Input('plot', 'value'),
+        Input('countries', 'value'),
+        Input('viewport', 'data'),
+        Input('comp-output', 'relayoutData'),
+    ]
+)
+def comparable_time_series(plot, countries, viewport, relayout_data):
+    x_range = x_range_for('comp-output', relayout_data)
+    # A new metric starts zoomed out
+    if 'plot.value' in triggered_inputs():
+        x_range = None
+    return generate_comparable_time_series(
+        plot, countries=countries or [], max_points=chart_points(viewport, 4), x_range=x_range)
+
+
+@lazy_panel('Death rates', 'figure')
+def death_rates(_):
+    return generate_deathrates_by_country(max_rows=40, ranking=current_dataset().death_rates)
+
+
+# The page for the current dataset, rebuilt whenever new data is installed
+current_layout = None
+
+
+def install(data):
+    # Build everything derived from the new data first, then swap it in
+    global current_layout
+    layout = build_layout(data)
+    swap_dataset(data)
+    current_layout = layout
+
+
+def serve_layout():
+    return current_layout
+
+
+# Background threads don't survive a fork, so when gunicorn preloads the app
+# (see gunicorn.conf.py) the refresher is started in the master once it's
+# ready instead, with an install that also replaces the workers
+refresher = None
+
+
+def start_background(install=install):
+    global refresher
+    refresher = start_refresher(install)
+
+
+install(load_dataset(DATA_SOURCE))
+app.layout = serve_layout
+if not os.environ.get('COVID_PRELOADED'):
+    start_background()
 
 
 if __name__ == '__main__':
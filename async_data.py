@@ -0,0 +1,153 @@
+import os
+import random
+import asyncio
+import logging
+import functools
+import requests
+
+from data import (
+    DATA_SOURCE,
+    CACHE_DIR,
+    OFFLINE,
+    REQUEST_TIMEOUT,
+    LOAD_WORKERS,
+    FRAME_RESOURCES,
+    make_session,
+    read_cached_meta,
+    fetch_path,
+    get_resources,
+    df_from_path,
+    get_df
+)
+
+# asyncio versions of the loaders in data.py. Downloads are bounded by a
+# semaphore, every attempt gets an overall timeout, and failed attempts are
+# retried with exponential backoff (plus jitter, so workers don't retry in
+# step) before falling back to the cached copy. The blocking work itself,
+# requests and the parsers, runs in the event loop's thread pool. A download
+# that timed out keeps its semaphore slot until its thread is done, so
+# retries can't pile up more than `concurrency` downloads.
+FETCH_TIMEOUT = float(os.environ.get('COVID_FETCH_TIMEOUT', 120))
+FETCH_RETRIES = int(os.environ.get('COVID_FETCH_RETRIES', 3))
+FETCH_BACKOFF = float(os.environ.get('COVID_FETCH_BACKOFF', 1.0))
+
+
+async def _in_thread(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def _in_thread_holding(semaphore, func, *args, **kwargs):
+    # Run func in a thread while holding a slot of the semaphore, which is only
+    # released when the thread finishes, even if the caller stopped waiting
+    await semaphore.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+
+    def done(future):
+        semaphore.release()
+        # Nobody may be waiting for it any more, so retrieve the exception here
+        if not future.cancelled():
+            future.exception()
+
+    future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+
+def _retryable(error):
+    # Client errors (404 and the like) won't go away by asking again
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return True
+
+
+async def fetch_path_async(url, session=None, semaphore=None, timeout=FETCH_TIMEOUT,
+                           retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, cache_dir=CACHE_DIR, offline=OFFLINE):
+    semaphore = semaphore or asyncio.Semaphore(1)
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.wait_for(
+                _in_thread_holding(semaphore, fetch_path, url, cache_dir, session, offline, REQUEST_TIMEOUT, fallback=False),
+                timeout
+            )
+        except (requests.RequestException, asyncio.TimeoutError) as e:
+            error = e
+            if attempt == retries or not _retryable(e):
+                break
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.info(f"Fetching {url} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    if read_cached_meta(url, cache_dir) is None:
+        raise error
+    logging.warning(f"Could not refresh {url} ({error!r}), using the cached copy")
+    return fetch_path(url, cache_dir, offline=True)
+
+
+async def get_resources_async(url=DATA_SOURCE, session=None, semaphore=None):
+    await fetch_path_async(url, session, semaphore)
+    # The cached copy is current now, so read it without going back to the network
+    return get_resources(url, offline=True)
+
+
+async def df_from_path_async(path, session=None, semaphore=None):
+    await fetch_path_async(path, session, semaphore)
+    return await _in_thread(df_from_path, path, offline=True)
+
+
+async def get_df_async(api, session=None, semaphore=None):
+    await fetch_path_async(api, session, semaphore)
+    return await _in_thread(get_df, api, offline=True)
+
+
+async def load_frames_async(url=DATA_SOURCE, concurrency=LOAD_WORKERS):
+    # Download and parse the four frames the dashboard is built from, all at
+    # once, so loading takes about as long as the slowest resource
+    semaphore = asyncio.Semaphore(concurrency)
+    with make_session(concurrency) as session:
+        resources, current_api = await get_resources_async(url, session, semaphore)
+        names = [name for name in FRAME_RESOURCES if name != 'df2']
+        frames = await asyncio.gather(
+            *[df_from_path_async(resources[FRAME_RESOURCES[name]], session, semaphore) for name in names],
+            get_df_async(current_api, session, semaphore)
+        )
+    return dict(zip(names + ['df2'], frames))
+
+
+async def refresh_resources_async(url=DATA_SOURCE, concurrency=LOAD_WORKERS):
+    # Bring the cached copies of all the resources up to date at once, without
+    # parsing them, and return get_resources(url)
+    semaphore = asyncio.Semaphore(concurrency)
+    with make_session(concurrency) as session:
+        resources, current_api = await get_resources_async(url, session, semaphore)
+        await asyncio.gather(*[
+            fetch_path_async(resources[resource], session, semaphore)
+            for resource in FRAME_RESOURCES.values()
+        ])
+    return resources, current_api
+
+
+def run(coroutine):
+    # Like asyncio.run, except that it doesn't wait for the threads of fetches
+    # that timed out. Those are left to finish (or hit REQUEST_TIMEOUT) on their own.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        tasks = asyncio.all_tasks(loop)
+        if tasks:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+
+def load_frames(url=DATA_SOURCE, concurrency=LOAD_WORKERS):
+    return run(load_frames_async(url, concurrency))
+
+
+def refresh_resources(url=DATA_SOURCE, concurrency=LOAD_WORKERS):
+    return run(refresh_resources_async(url, concurrency))
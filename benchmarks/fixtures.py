@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+# Synthetic stand-ins for the datahub resources, shaped like the real ones
+# (same files, columns and row order) and generated deterministically, so
+# every run benchmarks exactly the same data. At scale 1 they're about the
+# size of the real dataset; scale multiplies the number of locations and
+# days sets the length of the history.
+COUNTRIES = 190
+PROVINCES = 80
+DAYS = 90
+START_DATE = "2020-01-22"
+
+# The countries the dashboard refers to by name
+NAMED_COUNTRIES = [
+    "China", "United Kingdom", "Italy", "Spain", "Iran", "US",
+    "Vietnam", "New Zealand", "Mexico", "Korea, South", "France",
+    "Germany", "Brazil", "India", "Bosnia and Herzegovina",
+]
+
+
+def country_names(count):
+    return NAMED_COUNTRIES[:count] + [f"Country {i:06d}" for i in range(len(NAMED_COUNTRIES), count)]
+
+
+def _cumulative(rng, locations, days, rate):
+    # Cumulative counts, with each location's outbreak starting on a different day
+    daily = rng.poisson(rng.gamma(1.0, rate, size=(locations, 1)), size=(locations, days))
+    start = rng.integers(0, days // 2, size=(locations, 1))
+    daily[np.arange(days) < start] = 0
+    return daily.cumsum(axis=1)
+
+
+def generate_frames(scale=1, days=DAYS, seed=0):
+    rng = np.random.default_rng(seed)
+    countries = country_names(COUNTRIES * scale)
+    dates = pd.date_range(START_DATE, periods=days).strftime("%Y-%m-%d")
+
+    # Most countries are one location, a few are split into provinces
+    provinces = PROVINCES * scale
+    province_country = rng.integers(0, len(countries), size=provinces)
+    location_country = np.concatenate([np.arange(len(countries)), province_country])
+    location_province = [None] * len(countries) + [f"Province {i:06d}" for i in range(provinces)]
+    locations = len(location_country)
+
+    confirmed = _cumulative(rng, locations, days, 400)
+    deaths = (confirmed * rng.uniform(0.005, 0.12, size=(locations, 1))).astype(np.int64)
+    recovered = (confirmed * rng.uniform(0.1, 0.6, size=(locations, 1))).astype(np.int64)
+    lat = rng.uniform(-60, 70, size=locations).round(4)
+    long = rng.uniform(-180, 180, size=locations).round(4)
+
+    # Rows are grouped by location, each location's history in date order,
+    # like upstream (so new days are spread through the files, not at the end)
+    order = np.lexsort((np.arange(locations), np.asarray(countries, dtype=object)[location_country].astype(str)))
+    location_index = np.repeat(order, days)
+    date_index = np.tile(np.arange(days), locations)
+    combined = pd.DataFrame({
+        "Confirmed": confirmed[location_index, date_index],
+        "Country/Region": np.asarray(countries, dtype=object)[location_country][location_index],
+        "Date": dates[date_index],
+        "Deaths": deaths[location_index, date_index],
+        "Lat": lat[location_index],
+        "Long": long[location_index],
+        "Province/State": np.asarray(location_province, dtype=object)[location_index],
+        "Recovered": recovered[location_index, date_index],
+    })
+
+    countries_aggregated = (
+        combined.groupby(["Country/Region", "Date"], sort=True)[["Confirmed", "Recovered", "Deaths"]]
+        .sum()
+        .reset_index()
+        .rename(columns={"Country/Region": "Country"})
+        [["Date", "Country", "Confirmed", "Recovered", "Deaths"]]
+    )
+
+    worldwide = countries_aggregated.groupby("Date", sort=True)[["Confirmed", "Recovered", "Deaths"]].sum().reset_index()
+    worldwide["Increase rate"] = (worldwide["Confirmed"].pct_change() * 100).round(6)
+
+    keys = [
+        country if province is None else f"{province}, {country}"
+        for country, province in zip(np.asarray(countries, dtype=object)[location_country], location_province)
+    ]
+    reference = pd.DataFrame({
+        "UID": np.arange(locations),
+        "iso2": "XX",
+        "iso3": "XXX",
+        "code3": location_country,
+        "FIPS": np.nan,
+        "Admin2": np.nan,
+        "Province_State": location_province,
+        "Country_Region": np.asarray(countries, dtype=object)[location_country],
+        "Lat": lat,
+        "Long_": long,
+        "Combined_Key": keys,
+        "Population": rng.integers(50000, 100000000, size=locations),
+    })
+
+    return {
+        "worldwide-aggregate": worldwide,
+        "countries-aggregated": countries_aggregated,
+        "time-series-19-covid-combined_json": combined,
+        "reference": reference,
+    }
+
+
+FILES = {
+    "worldwide-aggregate": "worldwide-aggregate.csv",
+    "countries-aggregated": "countries-aggregated.csv",
+    "time-series-19-covid-combined_json": "time-series-19-covid-combined.json",
+    "reference": "reference.csv",
+}
+
+
+def write_fixtures(directory, scale=1, days=DAYS, seed=0):
+    # Write the resources and a datapackage.json pointing at them, and
+    # return the path of the datapackage.json
+    os.makedirs(directory, exist_ok=True)
+    resources = []
+    for name, df in generate_frames(scale, days, seed).items():
+        path = os.path.join(os.path.abspath(directory), FILES[name])
+        if path.endswith(".json"):
+            df.to_json(path, orient="records")
+        else:
+            df.to_csv(path, index=False)
+        resources.append({"name": name, "path": path})
+
+    package = os.path.join(directory, "datapackage.json")
+    with open(package, "w") as f:
+        json.dump({"name": "covid-19", "resources": resources}, f, indent=2)
+    return package
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else "fixtures"
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else DAYS
+    print(f"Wrote {write_fixtures(directory, scale, days)}")
@@ -0,0 +1,253 @@
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import inspect
+import tempfile
+import tracemalloc
+import subprocess
+
+from fixtures import DAYS, write_fixtures
+
+# Times the hot paths of the dashboard against the synthetic fixtures at a few
+# data sizes and reports wall time and peak (traced) memory for each. Sizes
+# are scales (multiples of the number of locations) at the default history
+# length, plus longer histories at scale 1, labelled like "1x/900d".
+# Every scale runs in a fresh process, since the app reads its configuration
+# and loads its data at import time.
+#
+#   python benchmarks/run.py                  # 1x, 10x, 100x and 1x/900d
+#   python benchmarks/run.py --scales 1 10 --days 90 --repeat 5 --filter generate_
+#   python benchmarks/run.py --json results.json
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCALES = [1, 10, 100]
+HISTORIES = [DAYS, DAYS * 10]
+REPEAT = 3
+
+
+def measure(func, repeat=REPEAT, setup=None):
+    # Best and median wall time over repeat runs, then the peak memory
+    # allocated during one more run under tracemalloc (which slows it down,
+    # so it isn't timed)
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2], 'peak': peak}
+
+
+def callback_body(output, inputs):
+    # The request the browser sends when an input of output's callback changes
+    return {
+        'output': output,
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'changedPropIds': [],
+    }
+
+
+def benchmarks(app, data):
+    # (name, function, setup) for everything that's timed. Figure functions
+    # are timed without the figure cache in front of them.
+    import helpers
+    import snapshot
+    import async_data
+    from data import DATA_SOURCE, get_resources, df_from_path, get_df
+    from dataset import Dataset
+
+    resources, current_api = get_resources(DATA_SOURCE)
+    frames, meta = snapshot.load_snapshot(snapshot.SNAPSHOT_DIR)
+    raw_ts_df = frames['ts_df']
+    comparable = inspect.unwrap(app.generate_comparable_time_series)
+    countries = ["China", "United Kingdom", "Italy", "Spain", "Iran", "US", "Vietnam", "New Zealand", "Mexico"]
+
+    yield 'get_resources', lambda: get_resources(DATA_SOURCE), None
+    for name in ('worldwide-aggregate', 'countries-aggregated', 'reference'):
+        yield f'df_from_path[{name}]', lambda name=name: df_from_path(resources[name]), None
+    yield 'get_df[combined json]', lambda: get_df(current_api), None
+    yield 'load_frames', lambda: async_data.load_frames(DATA_SOURCE), None
+    yield 'build_snapshot', lambda: snapshot.build_snapshot(DATA_SOURCE, snapshot.SNAPSHOT_DIR), None
+    yield 'load_snapshot', lambda: snapshot.load_snapshot(snapshot.SNAPSHOT_DIR), None
+    yield 'Dataset', lambda: Dataset(frames, meta), None
+
+    yield 'helpers.xth_date', lambda: [helpers.xth_date(raw_ts_df, c, 1000) for c in countries], None
+
+    yield 'generate_map_w_options', lambda: app.generate_map_w_options(data.df2, data.reference), None
+    yield 'generate_map_timelapse', lambda: app.generate_map_timelapse(data.df2, data.reference), None
+    yield 'generate_deathrates_by_country', lambda: app.generate_deathrates_by_country(
+        max_rows=40, ranking=helpers.DeathRateRanking(data.aggregates)), None
+    yield 'generate_world_ts_options', lambda: app.generate_world_ts_options(df=data.headline_df), None
+    yield 'generate_world_ts_options[decimated]', lambda: app.generate_world_ts_options(
+        df=data.headline_df, max_points=helpers.MIN_POINTS), None
+    yield 'generate_comparable_time_series', lambda: comparable("Confirmed"), None
+    yield 'generate_comparable_time_series[all countries]', lambda: comparable(
+        "Confirmed", countries=list(data.aligned.countries)), None
+    yield 'AlignedSeries.gather', lambda: data.aligned.gather(countries), None
+    yield 'generate_datatable', lambda: app.generate_datatable(data.ts_df), None
+
+    # Callback round trips through the Flask app, the way the browser makes them.
+    # Cold runs start with empty caches, warm runs are served from them.
+    client = app.server.test_client()
+    callbacks = [
+        ('cases map', 'World map of confirmed cases.figure', [('cases-map-mode', 'value', 'latest')]),
+        ('cases time-lapse', 'World map of confirmed cases.figure', [('cases-map-mode', 'value', 'timelapse')]),
+        ('deaths map', 'World map of confirmed deaths.figure', [('deaths-map-mode', 'value', 'latest')]),
+        ('world time series', 'Overall time series.figure', [
+            ('page-load', 'children', None),
+            ('viewport', 'data', app.DEFAULT_VIEWPORT_WIDTH),
+            ('Overall time series', 'relayoutData', None),
+        ]),
+        ('death rates', 'Death rates.figure', [('page-load', 'children', None)]),
+        ('comparable time series', 'comp-output.figure', [
+            ('plot', 'value', 'Confirmed'),
+            ('countries', 'value', app.COMPARABLE_COUNTRIES),
+            ('viewport', 'data', app.DEFAULT_VIEWPORT_WIDTH),
+            ('comp-output', 'relayoutData', None),
+        ]),
+        ('table page', '..Table.data...Table.page_count..', [
+            ('Table', 'page_current', 3),
+            ('Table', 'page_size', app.TABLE_PAGE_SIZE),
+            ('Table', 'sort_by', [{'column_id': 'Deaths', 'direction': 'desc'}]),
+            ('Table', 'filter_query', '{Confirmed} > 1000'),
+        ]),
+    ]
+
+    def clear_caches():
+        app.figure_cache.clear()
+        app.figure_responses.clear()
+        app._table_index = (None, None)
+
+    for label, output, inputs in callbacks:
+        def round_trip(body=callback_body(output, inputs)):
+            response = client.post('/_dash-update-component', json=body, headers={'Accept-Encoding': 'gzip, br'})
+            assert response.status_code == 200, response.status
+            return response.data
+
+        yield f'callback[{label}] cold', round_trip, clear_caches
+        yield f'callback[{label}] warm', round_trip, None
+
+
+def run_scale(args):
+    # Runs in the child process, with the environment pointing at the fixtures
+    sys.path.insert(0, REPO)
+    start = time.perf_counter()
+    import app
+    startup = time.perf_counter() - start
+
+    results = [{'name': 'app startup', 'best': startup, 'median': startup, 'peak': None}]
+    for name, func, setup in benchmarks(app, app.current_dataset()):
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        results.append(dict(measure(func, args.repeat, setup), name=name))
+        print(f"  {name}: {format_time(results[-1]['best'])}", file=sys.stderr)
+
+    import resource
+    results.append({'name': 'max rss', 'best': None, 'median': None,
+                    'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})
+    print(json.dumps(results))
+
+
+def format_size(size):
+    if size is None:
+        return ''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:,.1f} {unit}"
+        size /= 1024
+
+
+def format_time(seconds):
+    if seconds is None:
+        return ''
+    if seconds < 1:
+        return f"{seconds * 1000:,.2f} ms"
+    return f"{seconds:,.2f} s"
+
+
+def sizes(scales, histories):
+    # (label, scale, days) of every data size to run
+    runs = [(f"{scale}x", scale, DAYS) for scale in scales]
+    runs += [(f"1x/{days}d", 1, days) for days in histories if days != DAYS]
+    return runs
+
+
+def report(all_results):
+    labels = list(all_results)
+    names = []
+    for results in all_results.values():
+        names += [r['name'] for r in results if r['name'] not in names]
+    width = max(len(name) for name in names)
+
+    print(f"{'':{width}}" + ''.join(f" | {f'{label} time':>12} {f'{label} peak':>11}" for label in labels))
+    for name in names:
+        line = f"{name:{width}}"
+        for label in labels:
+            result = next((r for r in all_results[label] if r['name'] == name), {})
+            line += f" | {format_time(result.get('best')):>12} {format_size(result.get('peak')):>11}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark data loading and figure generation")
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help="data sizes, as multiples of the real dataset")
+    parser.add_argument('--days', type=int, nargs='+', default=HISTORIES,
+                        help=f"history lengths to also run at scale 1 (other than the default {DAYS})")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="timed runs per benchmark")
+    parser.add_argument('--filter', nargs='+', help="only run benchmarks whose name contains one of these")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--fixtures', help="keep the generated fixtures in this directory")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_scale(args)
+
+    root = args.fixtures or tempfile.mkdtemp(prefix='covid-benchmark-')
+    all_results = {}
+    try:
+        for label, scale, days in sizes(args.scales, args.days):
+            directory = os.path.join(root, label.replace('/', '-'))
+            print(f"Generating {label} fixtures in {directory}", file=sys.stderr)
+            package = write_fixtures(directory, scale, days)
+
+            env = dict(
+                os.environ,
+                COVID_DATA_SOURCE=package,
+                COVID_CACHE_DIR=os.path.join(directory, 'cache'),
+                COVID_REFRESH_INTERVAL='0',
+            )
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--repeat', str(args.repeat)]
+            if args.filter:
+                command += ['--filter'] + args.filter
+            print(f"Running {label} benchmarks", file=sys.stderr)
+            output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE).stdout
+            # The results are the last line, in case anything else was printed
+            all_results[label] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        if not args.fixtures:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report(all_results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
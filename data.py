@@ -1,9 +1,23 @@
 import requests
 import pandas as pd
 import io
+import os
+import json
+import hashlib
+import logging
 import datetime
+import threading
+import contextlib
+import numpy as np
+
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
 
 class Country:
+    __slots__ = ('country', 'population', 'coords', 'confirmed', 'deaths')
+
     def __init__(self, data):
         self.country = data['country']
         self.population = data['country_population']
@@ -15,35 +29,318 @@ class Country:
         return self.country
 
 
-DATA_SOURCE = 'https://datahub.io/core/covid-19/datapackage.json'
+DATA_SOURCE = os.environ.get('COVID_DATA_SOURCE', 'https://datahub.io/core/covid-19/datapackage.json')
+
+# Every downloaded resource is kept on disk so that workers can revalidate
+# instead of re-downloading, and can still boot if the upstream is down
+CACHE_DIR = os.environ.get('COVID_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+OFFLINE = os.environ.get('COVID_OFFLINE', '') not in ('', '0')
+REQUEST_TIMEOUT = 30
+CHUNK_SIZE = 1 << 20
+
+# The resources are downloaded and parsed concurrently, this many at a time (see async_data.py)
+LOAD_WORKERS = int(os.environ.get('COVID_LOAD_WORKERS', 4))
+
+
+def _cache_paths(url, cache_dir):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key), os.path.join(cache_dir, f"{key}.meta.json")
+
+
+@contextlib.contextmanager
+def _atomic_file(path):
+    # A file to write path through. It's written under a temporary name and
+    # only renamed over path once it's complete, so other workers never read
+    # half a file; if writing fails, path is left as it was.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_atomic(path, content):
+    with _atomic_file(path) as f:
+        f.write(content)
+
+
+def read_cached_meta(url, cache_dir=CACHE_DIR):
+    # Return the metadata of the last good copy of url, or None if we have none
+    body_path, meta_path = _cache_paths(url, cache_dir)
+    if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def fetch_path(url, cache_dir=CACHE_DIR, session=None, offline=OFFLINE, timeout=REQUEST_TIMEOUT, fallback=True):
+    # Make sure the on-disk cache holds a current copy of url and return its path.
+    # A cached copy is revalidated with a conditional GET (ETag / Last-Modified)
+    # and is used as-is if we're offline or (with fallback) the upstream request fails.
+    # Downloads are streamed to disk so they're never held in memory whole.
+    if not url.startswith(('http://', 'https://')):
+        # Local files (a mirror, or the benchmark fixtures) are read in place
+        return url[len('file://'):] if url.startswith('file://') else url
+
+    session = session or requests
+    body_path, meta_path = _cache_paths(url, cache_dir)
+    meta = read_cached_meta(url, cache_dir)
 
-def get_resources(url=DATA_SOURCE):
-    r = requests.get(url)
+    if offline:
+        if meta is None:
+            raise FileNotFoundError(f"No cached copy of {url} available in {cache_dir}")
+        return body_path
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        with session.get(url, headers=headers, timeout=timeout, stream=True) as r:
+            if r.status_code == 304 and meta is not None:
+                return body_path
+            r.raise_for_status()
+            os.makedirs(cache_dir, exist_ok=True)
+            with _atomic_file(body_path) as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+            headers = r.headers
+    except requests.RequestException as e:
+        if meta is None or not fallback:
+            raise
+        logging.warning(f"Could not refresh {url} ({e}), using cached copy from {meta.get('fetched')}")
+        return body_path
+
+    _write_atomic(meta_path, json.dumps({
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'fetched': datetime.datetime.utcnow().isoformat(),
+    }).encode('utf-8'))
+    return body_path
+
+
+def fetch(url, cache_dir=CACHE_DIR, session=None, offline=OFFLINE, timeout=REQUEST_TIMEOUT):
+    # Get the raw bytes at url, going through the on-disk cache
+    with open(fetch_path(url, cache_dir, session, offline, timeout), 'rb') as f:
+        return f.read()
+
+
+# The frames the dashboard is built from, and the resource each one comes from
+FRAME_RESOURCES = {
+    'headline_df': 'worldwide-aggregate',
+    'ts_df': 'countries-aggregated',
+    'df2': 'time-series-19-covid-combined_json',
+    'ref_table': 'reference',
+}
+
+
+def make_session(pool_size=LOAD_WORKERS):
+    # A session whose connection pool is big enough for every loader thread,
+    # so concurrent downloads from the same host reuse their connections
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_resources(url=DATA_SOURCE, session=None, offline=OFFLINE):
+    package = json.loads(fetch(url, session=session, offline=offline))
     resources = {}
+    current_api = None
 
-    for i in range(len(r.json()['resources'])):
-        if r.json()['resources'][i]['name'] == 'time-series-19-covid-combined_json':
-            current_api = r.json()['resources'][i]['path']
-        res_name = r.json()['resources'][i]['name']
-        res_path = r.json()['resources'][i]['path']
-        resources[res_name] = res_path
+    for resource in package['resources']:
+        if resource['name'] == 'time-series-19-covid-combined_json':
+            current_api = resource['path']
+        resources[resource['name']] = resource['path']
 
     return resources, current_api
 
 
-def get_df(api):
+# The columns of the combined time series that the dashboard uses, and their kinds
+COMBINED_COLUMNS = {
+    'Date': 'date',
+    'Country/Region': 'category',
+    'Confirmed': 'number',
+    'Recovered': 'number',
+    'Deaths': 'number',
+}
+
+
+def _open_json(source):
+    # A JSON document is read from its path, or from bytes already in memory
+    return open(source, 'rb') if isinstance(source, str) else io.BytesIO(source)
+
+
+def _count_records(source):
+    # Records are flat objects, so counting braces sizes the columns up front
+    n = 0
+    with _open_json(source) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            n += chunk.count(b'{')
+    return n
+
+
+def stream_json_df(source, columns=COMBINED_COLUMNS):
+    # Read a JSON array of flat records (from a path, or bytes) one record at a
+    # time straight into preallocated typed columns, keeping only `columns`, so
+    # the document is never held in memory as a whole. Text columns are stored
+    # as category codes.
+    n = _count_records(source)
+    numbers = {column: np.full(n, np.nan) for column, kind in columns.items() if kind == 'number'}
+    codes = {column: np.full(n, -1, dtype=np.int32) for column, kind in columns.items() if kind != 'number'}
+    categories = {column: {} for column in codes}
+
+    i = 0
+    with _open_json(source) as f:
+        for record in ijson.items(f, 'item'):
+            for column, values in numbers.items():
+                value = record.get(column)
+                if value is not None:
+                    values[i] = value
+            for column, column_codes in codes.items():
+                value = record.get(column)
+                if value is not None:
+                    column_categories = categories[column]
+                    column_codes[i] = column_categories.setdefault(value, len(column_categories))
+            i += 1
+
+    data = {}
+    for column, kind in columns.items():
+        if kind == 'number':
+            values = numbers[column][:i]
+            # Keep whole counts as integers, like the JSON had them
+            if not np.isnan(values).any() and np.array_equal(values, np.floor(values)):
+                values = values.astype(np.int64)
+            data[column] = values
+        elif kind == 'date':
+            dates = np.append(pd.to_datetime(list(categories[column])).values, np.datetime64('NaT'))
+            data[column] = dates[codes[column][:i]]
+        else:
+            data[column] = pd.Categorical.from_codes(codes[column][:i], categories=list(categories[column]))
+
+    return pd.DataFrame(data, columns=list(columns))
+
+
+def get_df(api, session=None, offline=OFFLINE):
     # api should be the current_api returned from get_resources
-    r = requests.get(api)
-    s2_data = r.json()
-    df = pd.json_normalize(r.json())
-    return df
+    return stream_json_df(fetch_path(api, session=session, offline=offline))
 
 
-def df_from_path(path):
+def df_from_path(path, session=None, offline=OFFLINE):
     if "csv" in path:
-        new_r = requests.get(path).content
-        df = pd.read_csv(io.StringIO(new_r.decode('utf-8')))
+        df = pd.read_csv(io.BytesIO(fetch(path, session=session, offline=offline)))
     elif "json" in path:
-        new_r = requests.get(path)
-        df = pd.json_normalize(new_r.json())
+        df = pd.json_normalize(json.loads(fetch(path, session=session, offline=offline)))
     return df
+
+
+# Incremental refreshes only parse the rows dated after what we hold. Those
+# are spread all over a resource (upstream groups the rows by location, not
+# date), so every row's date is read straight out of the raw bytes, all at
+# once with numpy, and only the rows with a later date are handed to the
+# parsers. Dates are compared as ISO 8601 text, which sorts like the dates.
+DATE_WIDTH = len('2020-01-22')
+
+
+def _dates_at(buf, positions):
+    # The dates written at positions of buf, as an array of bytes, or None if
+    # any of them isn't a YYYY-MM-DD date
+    if len(positions) and positions[-1] + DATE_WIDTH > len(buf):
+        return None
+    chars = buf[positions[:, None] + np.arange(DATE_WIDTH)]
+    digits = np.delete(chars, [4, 7], axis=1)
+    if not ((chars[:, [4, 7]] == ord('-')).all() and ((digits >= ord('0')) & (digits <= ord('9'))).all()):
+        return None
+    return chars.view(f'S{DATE_WIDTH}').ravel()
+
+
+def _find_all(buf, pattern, anchor=0):
+    # Where pattern starts in buf. The candidates are where its anchor byte
+    # is (best a rare one), narrowed down a byte at a time.
+    starts = np.flatnonzero(buf == pattern[anchor]) - anchor
+    starts = starts[(starts >= 0) & (starts + len(pattern) <= len(buf))]
+    for k in range(len(pattern)):
+        starts = starts[buf[starts + k] == pattern[k]]
+    return starts
+
+
+def _skip_spaces(buf, positions):
+    # The positions moved past any JSON whitespace
+    while True:
+        positions = np.minimum(positions, len(buf) - 1)
+        spaces = np.isin(buf[positions], np.frombuffer(b' \t\r\n', dtype=np.uint8))
+        if not spaces.any():
+            return positions
+        positions = positions + spaces
+
+
+def _date_text(date):
+    return np.bytes_(f"{pd.Timestamp(date):%Y-%m-%d}")
+
+
+def csv_rows_after(content, last_date, held_rows, date_column='Date'):
+    # The rows of a CSV dated after last_date, wherever they are in the file.
+    # The date has to be the first column, so that each line starts with it.
+    # Returns None if the file isn't laid out like that, or if the number of
+    # rows up to last_date doesn't match what we hold, i.e. history was revised.
+    buf = np.frombuffer(content, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    header = content[:newlines[0] if len(newlines) else len(content)]
+    if header.split(b',')[0].strip(b'"\r') != date_column.encode('utf-8'):
+        return None
+
+    starts = newlines + 1
+    ends = np.append(newlines[1:], len(buf))
+    starts, ends = starts[ends > starts], ends[ends > starts]
+    dates = _dates_at(buf, starts)
+    if dates is None or not (buf[np.minimum(starts + DATE_WIDTH, len(buf) - 1)] == ord(',')).all():
+        return None
+
+    newer = dates > _date_text(last_date)
+    if len(dates) - newer.sum() != held_rows:
+        return None
+    lines = [content[start:end] for start, end in zip(starts[newer], ends[newer])]
+    return pd.read_csv(io.BytesIO(b'\n'.join([header] + lines)))
+
+
+def json_rows_after(path, last_date, held_rows, columns=COMBINED_COLUMNS, date_column='Date'):
+    # The records of a JSON array dated after last_date. Records are flat
+    # objects, so there's one '{' per record, each record's date is the string
+    # after its date key, and a record runs from the '{' before that to the
+    # '}' after it. Returns None if the file isn't laid out like that, or if
+    # history was revised.
+    with open(path, 'rb') as f:
+        content = f.read()
+    buf = np.frombuffer(content, dtype=np.uint8)
+    key = json.dumps(date_column).encode('utf-8')
+    # Anchored on the key's first letter, which is rarer than its quote
+    colons = _skip_spaces(buf, _find_all(buf, key, anchor=1) + len(key))
+    quotes = _skip_spaces(buf, colons + 1)
+    if len(quotes) != content.count(b'{') or not ((buf[colons] == ord(':')) & (buf[quotes] == ord('"'))).all():
+        return None
+    keys = quotes + 1
+    dates = _dates_at(buf, keys)
+    if dates is None or not (buf[np.minimum(keys + DATE_WIDTH, len(buf) - 1)] == ord('"')).all():
+        return None
+
+    newer = dates > _date_text(last_date)
+    if len(dates) - newer.sum() != held_rows:
+        return None
+    records = [content[content.rfind(b'{', 0, k):content.find(b'}', k) + 1] for k in keys[newer]]
+    return stream_json_df(b'[' + b','.join(records) + b']', columns)
+
+
+def df_after(path, last_date, held_rows, offline=OFFLINE):
+    # The rows of a resource dated after last_date (see csv_rows_after)
+    if "csv" in path:
+        return csv_rows_after(fetch(path, offline=offline), last_date, held_rows)
+    elif "json" in path:
+        return json_rows_after(fetch_path(path, offline=offline), last_date, held_rows)
@@ -0,0 +1,80 @@
+from data import DATA_SOURCE
+
+from snapshot import (
+    SNAPSHOT_DIR,
+    load_or_build
+)
+
+from metrics import DATA_LOAD_SECONDS
+
+from helpers import (
+    index_by_date,
+    DailyAggregates,
+    DeathRateRanking,
+    AlignedSeries,
+    ReferenceIndex
+)
+
+
+class Dataset:
+    # Everything the dashboard shows, built from one snapshot of the data.
+    # A dataset is never modified once built: a refresh builds a new one and
+    # swaps it in, so a callback holding a dataset always sees consistent data.
+    # If the snapshot only appended rows to the one previous was built from,
+    # the aggregates are extended with those rows instead of built again.
+    @DATA_LOAD_SECONDS.time(step='dataset')
+    def __init__(self, frames, meta, previous=None):
+        self.version = meta['version']
+        self.built = meta['built']
+
+        self.headline_df = frames['headline_df']
+        self.ts_df = index_by_date(frames['ts_df'], 'Country')
+        self.df2 = index_by_date(frames['df2'], 'Country/Region')
+        self.ref_table = frames['ref_table']
+        self.reference = ReferenceIndex(self.ref_table)
+
+        self.aggregates = None
+        if previous is not None and meta.get('previous') == previous.version:
+            self.aggregates = previous.aggregates.extend(
+                _appended_rows(frames['headline_df'], meta, 'headline_df'),
+                _appended_rows(frames['ts_df'], meta, 'ts_df')
+            )
+        if self.aggregates is None:
+            self.aggregates = DailyAggregates(self.headline_df, self.ts_df)
+        self.death_rates = DeathRateRanking(self.aggregates)
+        self.aligned = AlignedSeries(self.aggregates)
+
+        # Current day figures
+        latest = self.aggregates.on()
+        self.current_date = self.aggregates.dates[-1]
+        self.current_confirmed = latest['Confirmed']
+        self.current_recovered = latest['Recovered']
+        self.current_deaths = latest['Deaths']
+
+        # Growth rates
+        self.confirmed_growth = latest['Confirmed growth']
+        self.recovered_growth = latest['Recovered growth']
+        self.deaths_growth = latest['Deaths growth']
+
+
+def _appended_rows(df, meta, name):
+    # The rows the snapshot appended to the frame, they're at its end
+    return df.iloc[len(df) - meta['appended'][name]:]
+
+
+_current = None
+
+
+def load_dataset(url=DATA_SOURCE, path=SNAPSHOT_DIR):
+    frames, meta = load_or_build(url, path)
+    return Dataset(frames, meta)
+
+
+def current_dataset():
+    return _current
+
+
+def swap_dataset(dataset):
+    # A single reference assignment, so readers get either the old or the new one
+    global _current
+    _current = dataset
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import html
+import shutil
+import inspect
+import argparse
+from datetime import datetime
+
+import plotly
+
+import app
+from app import (
+    CONFIRMED_COLOUR,
+    RECOVERED_COLOUR,
+    DEATHS_COLOUR,
+    FONT,
+    MAP_MODES,
+    PLOT_OPTIONS,
+    MINIMALIST_CONFIG,
+    formatted_mvmt,
+    generate_map_w_options,
+    generate_map_timelapse,
+    generate_world_ts_options,
+    generate_deathrates_by_country,
+    generate_datatable
+)
+
+from dataset import current_dataset
+
+from responses import CompressedPayload
+
+# Renders the dashboard for the current data into a directory of static files
+# that any web server or CDN can serve, with no Python behind it: an HTML page
+# with the table and headline figures in it, the JSON of every figure
+# (including each option of the radio buttons) and plotly.js. Every file also
+# gets .gz and .br (if Brotli is installed) variants next to it, for nginx's
+# gzip_static/brotli_static and CDNs that serve precompressed files.
+#
+#   python export.py [directory]
+EXPORT_DIR = os.environ.get('COVID_EXPORT_DIR', 'export')
+CSS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'css')
+
+
+def export_figures(data):
+    # Every figure on the page, by the name of its file
+    comparable = inspect.unwrap(app.generate_comparable_time_series)
+    figures = {}
+    for mode in MAP_MODES:
+        if mode['value'] == "timelapse":
+            figures["cases-map-timelapse"] = generate_map_timelapse(data.df2, data.reference, "Confirmed")
+            figures["deaths-map-timelapse"] = generate_map_timelapse(data.df2, data.reference, "Deaths")
+        else:
+            figures[f"cases-map-{mode['value']}"] = generate_map_w_options(
+                data.df2, data.reference, plot_recoveries=False, plot_deaths=False)
+            figures[f"deaths-map-{mode['value']}"] = generate_map_w_options(
+                data.df2, data.reference, plot_cases=False, plot_recoveries=False)
+    for option in PLOT_OPTIONS:
+        figures[f"comparable-{option['value']}"] = comparable(
+            option['value'], aligned=data.aligned, reference=data.reference)
+    figures["world-time-series"] = generate_world_ts_options(df=data.headline_df)
+    figures["death-rates"] = generate_deathrates_by_country(max_rows=40, ranking=data.death_rates)
+    return figures
+
+
+def _radio_items(name, target, options, prefix):
+    return "".join(
+        f'<label style="display: inline-block"><input type="radio" name="{name}" data-target="{target}" '
+        f'value="{prefix}{html.escape(option["value"])}"{" checked" if i == 0 else ""}>{html.escape(option["label"])}</label>'
+        for i, option in enumerate(options)
+    )
+
+
+def _grid_element(col, row, width, height, content):
+    return (
+        f'<div class="dui-grid-element" style="grid-column: {col} / span {width}; grid-row: {row} / span {height}">'
+        f'{content}</div>'
+    )
+
+
+def _graph_panel(graph_id, radio_items=""):
+    if not radio_items:
+        return f'<div id="{graph_id}" style="height: 100%; width: 100%"></div>'
+    return (
+        f'<div style="height: 100%; width: 100%">'
+        f'<div style="height: 10%; font-family: {FONT}; text-align: center; background-color: white">{radio_items}</div>'
+        f'<div id="{graph_id}" style="height: 90%; width: 100%"></div></div>'
+    )
+
+
+def _table(df):
+    df = df.sort_values("Confirmed", ascending=False)
+    head = "".join(f"<th>{html.escape(column)}</th>" for column in df.columns)
+    rows = "".join(
+        "<tr>" + "".join(
+            f"<td>{html.escape(value) if isinstance(value, str) else f'{value:,}'}</td>" for value in row
+        ) + "</tr>"
+        for row in df.itertuples(index=False)
+    )
+    return f'<table style="width: 100%"><thead><tr>{head}</tr></thead><tbody>{rows}</tbody></table>'
+
+
+def _headline(data):
+    figures = [
+        ("Cases", data.current_confirmed, data.confirmed_growth, CONFIRMED_COLOUR),
+        ("Recoveries", data.current_recovered, data.recovered_growth, RECOVERED_COLOUR),
+        ("Deaths", data.current_deaths, data.deaths_growth, DEATHS_COLOUR),
+    ]
+    lines = "".join(
+        f'<div><h5 style="color: {colour}; font-weight: bold; display: inline">{label}: {value:,}</h5>'
+        f'<p style="font-size: 1.2rem; display: inline"> {formatted_mvmt(growth, "")}</p></div>'
+        for label, value, growth, colour in figures
+    )
+    return (
+        f'<div style="font-family: {FONT}; text-align: center; background-color: white; height: 100%; display: flow-root">'
+        f'<h4 style="font-weight: bold">Covid-19 dashboard</h4>'
+        f'<p style="font-weight: bold">Worldwide headline figures:</p>'
+        f'{lines}'
+        f'<p style="margin-top: 0.75em">Data accurate as at {data.current_date:%Y-%m-%d}</p>'
+        f'<p>Created by Christian Kneller</p>'
+        f'<p>Source code available at <a href="https://github.com/ChrisKneller/covid-dashboard/" target="_blank">github</a></p>'
+        f'</div>'
+    )
+
+
+# Draws each graph from its figure file, and swaps figures when a radio button changes
+SCRIPT = """
+var version = %(version)s;
+var config = %(config)s;
+function draw(target, name) {
+    fetch("figures/" + name + ".json?v=" + version)
+        .then(function (response) { return response.json(); })
+        .then(function (figure) {
+            figure.config = config;
+            Plotly.newPlot(target, figure);
+        });
+}
+%(initial)s
+document.querySelectorAll("input[data-target]").forEach(function (input) {
+    input.addEventListener("change", function () { draw(input.dataset.target, input.value); });
+});
+"""
+
+
+def render_page(data, stylesheets):
+    grid = "".join([
+        _grid_element(1, 1, 6, 4, _graph_panel(
+            "cases-map", _radio_items("cases-map-mode", "cases-map", MAP_MODES, "cases-map-"))),
+        _grid_element(7, 1, 6, 4, _graph_panel(
+            "deaths-map", _radio_items("deaths-map-mode", "deaths-map", MAP_MODES, "deaths-map-"))),
+        _grid_element(1, 5, 4, 4, _table(generate_datatable(data.ts_df))),
+        _grid_element(5, 5, 4, 4, _headline(data)),
+        _grid_element(9, 5, 4, 4, _graph_panel(
+            "comparable", _radio_items("plot", "comparable", PLOT_OPTIONS, "comparable-"))),
+        _grid_element(1, 9, 6, 4, _graph_panel("world-time-series")),
+        _grid_element(7, 9, 6, 4, _graph_panel("death-rates")),
+    ])
+    initial = "\n".join(f'draw("{target}", "{name}");' for target, name in [
+        ("cases-map", f"cases-map-{MAP_MODES[0]['value']}"),
+        ("deaths-map", f"deaths-map-{MAP_MODES[0]['value']}"),
+        ("comparable", f"comparable-{PLOT_OPTIONS[0]['value']}"),
+        ("world-time-series", "world-time-series"),
+        ("death-rates", "death-rates"),
+    ])
+    script = SCRIPT % {
+        'version': json.dumps(data.version),
+        'config': json.dumps(MINIMALIST_CONFIG),
+        'initial': initial,
+    }
+    links = "".join(f'<link rel="stylesheet" href="{href}?v={data.version}">' for href in stylesheets)
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Covid-19 dashboard</title>
+{links}
+<script src="plotly.min.js?v={plotly.__version__}"></script>
+</head>
+<body>
+<div style="height: 100vh; width: 100vw">
+<div class="dui-layout"><div class="dui-grid-wrapper"><div class="dui-grid dui-grid-12-rows dui-grid-12-cols dui-grid-2-padding">{grid}</div></div></div>
+</div>
+<script>{script}</script>
+</body>
+</html>
+"""
+
+
+def write_file(directory, name, content):
+    # Write a file along with its precompressed variants, and return its size
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    variants = CompressedPayload(content).variants
+    for encoding, suffix in (('identity', ''), ('gzip', '.gz'), ('br', '.br')):
+        if encoding in variants:
+            with open(path + suffix, 'wb') as f:
+                f.write(variants[encoding][0])
+    return len(variants['identity'][0])
+
+
+def _swap_link(directory, target):
+    # Point the symlink at directory to target (a directory next to it) in one
+    # rename, and return what it pointed to before. An export directory from
+    # before exports were symlinked is moved out of the way first.
+    tmp = f"{directory}.{os.getpid()}.link"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+
+    previous = None
+    if os.path.islink(directory):
+        previous = os.readlink(directory)
+    elif os.path.exists(directory):
+        old = f"{directory}.{os.getpid()}.old"
+        os.rename(directory, old)
+        shutil.rmtree(old)
+    os.replace(tmp, directory)
+    return previous
+
+
+def _remove_old_exports(directory, keep):
+    # Delete the versioned export directories next to directory, except keep
+    parent, name = os.path.split(directory)
+    pattern = re.compile(re.escape(name) + r"\.\d{20}\.\d+")
+    for entry in os.listdir(parent or "."):
+        if pattern.fullmatch(entry) and entry not in keep:
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+def export(directory=EXPORT_DIR, data=None):
+    data = data or current_dataset()
+
+    # Build into a directory of its own, then atomically repoint the symlink at
+    # directory to it, so a server never serves half of one export and half of
+    # another. The previous export is kept until the next one, for requests
+    # that were already on their way through the old link.
+    directory = directory.rstrip(os.sep)
+    target = f"{os.path.basename(directory)}.{datetime.now():%Y%m%d%H%M%S%f}.{os.getpid()}"
+    tmp = os.path.join(os.path.dirname(directory), target)
+
+    sizes = {}
+    for name, figure in export_figures(data).items():
+        sizes[f"figures/{name}.json"] = write_file(
+            tmp, f"figures/{name}.json", json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+
+    stylesheets = []
+    for name in sorted(os.listdir(CSS_DIR)):
+        with open(os.path.join(CSS_DIR, name)) as f:
+            sizes[f"css/{name}"] = write_file(tmp, f"css/{name}", f.read())
+        stylesheets.append(f"css/{name}")
+
+    sizes["plotly.min.js"] = write_file(tmp, "plotly.min.js", plotly.offline.get_plotlyjs())
+    sizes["index.html"] = write_file(tmp, "index.html", render_page(data, stylesheets))
+
+    previous = _swap_link(directory, target)
+    _remove_old_exports(directory, keep={target, previous})
+    return sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the dashboard as static files")
+    parser.add_argument('directory', nargs='?', default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    sizes = export(args.directory)
+    data = current_dataset()
+    print(f"Exported data version {data.version} ({data.current_date:%Y-%m-%d}) to {args.directory}")
+    for name, size in sorted(sizes.items()):
+        print(f"  {name}: {size:,} bytes")
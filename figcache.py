@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+import plotly
+
+from data import (
+    CACHE_DIR,
+    _write_atomic
+)
+
+from metrics import (
+    FIGURE_SECONDS,
+    FIGURE_BYTES
+)
+
+# Figures only change when their inputs or the data change, so callbacks can
+# serve them from a cache keyed by both. Entries are kept as serialized JSON in
+# a small in-process LRU, backed by a directory shared by all gunicorn workers.
+FIGURE_CACHE_DIR = os.environ.get('COVID_FIGURE_CACHE_DIR', os.path.join(CACHE_DIR, 'figures'))
+FIGURE_CACHE_SIZE = int(os.environ.get('COVID_FIGURE_CACHE_SIZE', 128))
+
+
+class FigureCache:
+    def __init__(self, size=FIGURE_CACHE_SIZE, directory=FIGURE_CACHE_DIR):
+        self.size = size
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key)) as f:
+                value = f.read()
+            # Mark it as recently used for the other workers too
+            os.utime(self._path(key))
+        except OSError:
+            return None
+
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if not self.directory:
+            return
+
+        _write_atomic(self._path(key), value.encode('utf-8'))
+        self._evict_files()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _evict_files(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    files.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except OSError:
+                    pass
+        files.sort()
+        for _, name in files[:max(0, len(files) - self.size)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def cache_key(name, version, args, kwargs):
+    raw = json.dumps([name, version, args, sorted(kwargs.items())], default=repr)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def cached_figure(cache, version):
+    # Decorator for figure-returning functions. version is a callable returning
+    # the current data version, so a data refresh never serves stale figures.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cache_key(func.__qualname__, version(), args, kwargs)
+            value = cache.get(key)
+            if value is None:
+                start = time.perf_counter()
+                value = json.dumps(func(*args, **kwargs), cls=plotly.utils.PlotlyJSONEncoder)
+                FIGURE_SECONDS.observe(time.perf_counter() - start, figure=func.__qualname__)
+                FIGURE_BYTES.observe(len(value), figure=func.__qualname__)
+                cache.set(key, value)
+            return json.loads(value)
+        return wrapper
+    return decorator
@@ -0,0 +1,48 @@
+import os
+import gc
+import signal
+
+# With preloading, the master process imports the app, and so loads the data
+# and builds everything derived from it, once before forking the workers. The
+# workers then share those pages with the master instead of each holding a
+# copy. The master also does the refreshing: when it installs new data it
+# reloads, as on SIGHUP, which forks new workers from it (with the new data)
+# and lets the old ones finish their requests and exit. So a refresh never
+# leaves each worker holding its own copy of the new data.
+# Set COVID_PRELOAD=0 to have every worker load and refresh the data itself.
+preload_app = os.environ.get('COVID_PRELOAD', '1') not in ('', '0')
+
+# Threaded workers, so a worker keeps answering requests while others wait
+worker_class = 'gthread'
+threads = int(os.environ.get('COVID_THREADS', 4))
+
+if preload_app:
+    # Tells app.py to leave starting its background threads to when_ready
+    os.environ['COVID_PRELOADED'] = '1'
+
+
+def freeze():
+    # Keep the garbage collector from touching (and so copying) the objects
+    # the workers inherit from the master
+    gc.unfreeze()
+    gc.collect()
+    gc.freeze()
+
+
+def install_and_reload(server, data):
+    import app
+    app.install(data)
+    os.kill(server.pid, signal.SIGHUP)
+
+
+def when_ready(server):
+    if preload_app:
+        freeze()
+        import app
+        app.start_background(lambda data: install_and_reload(server, data))
+
+
+def on_reload(server):
+    # Runs in the master just before the new workers are forked
+    if preload_app:
+        freeze()
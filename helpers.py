@@ -1,21 +1,571 @@
+import functools
+import numpy as np
+import pandas as pd
+
+
+METRIC_COLUMNS = {
+    "cases": "Confirmed",
+    "recoveries": "Recovered",
+    "deaths": "Deaths",
+}
+
+
 def filter_df(df, column, value):
     return df.loc[df[column] == value]
 
 
+def index_by_date(df, country_column="Country"):
+    # Give a time series frame a sorted (date, country) MultiIndex, so rows for
+    # a date or a range of dates can be found by binary search. The columns
+    # are kept as they are, so the frame can still be used like before.
+    # Frames already in that order (like the snapshot's) share their columns
+    # with df instead of being copied.
+    index = pd.MultiIndex.from_arrays(
+        [pd.DatetimeIndex(df["Date"]), df[country_column]],
+        names=["date", "country"]
+    )
+    if index.is_monotonic_increasing:
+        df = df.copy(deep=False)
+        df.index = index
+        return df
+    return df.set_index(index).sort_index(kind="mergesort")
+
+
+def date_slice(df, start, end=None):
+    # Rows of a frame indexed by index_by_date from start to end (inclusive),
+    # or just on start. A slice of df, not a copy.
+    end = start if end is None else end
+    first, last = df.index.slice_locs(pd.Timestamp(start), pd.Timestamp(end))
+    return df.iloc[first:last]
+
+
+def latest_date(df):
+    # The last date in a frame indexed by index_by_date
+    return df.index[-1][0]
+
+
 def xth_date(df, country, x, data="cases"):
     # df should be df_from_path(resources['countries-aggregated'])
+    if data not in METRIC_COLUMNS:
+        raise ValueError("'data' variable must be equal to 'cases', 'recoveries' or 'deaths'")
     country_df = filter_df(df, 'Country', country)
 
-    if data == "cases":
-        j = 2
-    elif data == "recoveries":
-        j = 3
-    elif data == "deaths":
-        j = 4
+    # The first row reaching x is the first where the running maximum does,
+    # and the running maximum is sorted, so it's a binary search
+    running_max = country_df[METRIC_COLUMNS[data]].fillna(-np.inf).cummax().to_numpy()
+    i = np.searchsorted(running_max, x, side="left")
+    if i == len(country_df):
+        return False
+    return country_df["Date"].iloc[i]
+
+
+def latest_by_location(df, ref, columns=("Confirmed", "Recovered", "Deaths")):
+    # Totals per location on the latest date of df (the combined time series,
+    # indexed by index_by_date), joined with the coordinates of each location from the reference table
+    latest = date_slice(df, latest_date(df))
+    totals = latest.groupby(latest["Country/Region"].astype(str), sort=False)[list(columns)].sum()
+    return totals.join(coordinates(ref), how="inner")
+
+
+def coordinates(ref):
+    # Lat and Long_ of every location in the reference table (or a
+    # ReferenceIndex built from it), by Combined_Key
+    if isinstance(ref, ReferenceIndex):
+        return ref.coordinates
+    coords = ref[["Combined_Key", "Lat", "Long_"]].dropna()
+    coords = coords.assign(Combined_Key=coords["Combined_Key"].astype(str))
+    return coords.drop_duplicates("Combined_Key").set_index("Combined_Key")
+
+
+def location_matrix(df, ref, column="Confirmed"):
+    # A (date x location) matrix of one metric from the combined time series,
+    # for the locations that have coordinates, and those coordinates
+    matrix = df.pivot_table(index="Date", columns="Country/Region", values=column, aggfunc="sum", observed=True)
+    matrix.columns = matrix.columns.astype(str)
+
+    coords = coordinates(ref)
+    matrix = matrix.loc[:, matrix.columns.isin(coords.index)]
+    return matrix, coords.loc[matrix.columns]
+
+
+class DailyAggregates:
+    # Totals, day-over-day changes, growth rates and 7 day averages of the
+    # daily changes for every date, both worldwide and per country. Everything
+    # is worked out up front with whole-table operations, so reading the
+    # numbers for any date is a lookup rather than a scan of the frames.
+    STATS = ("change", "growth", "7 day average")
+    # Days the averages are taken over
+    WINDOW = 7
+
+    def __init__(self, headline_df, ts_df):
+        metrics = list(METRIC_COLUMNS.values())
+        self.world = self._with_stats(headline_df.set_index("Date")[metrics])
+        self.countries = self._with_stats(self._pivot(ts_df))
+        self._index()
+
+    @staticmethod
+    def _pivot(ts_df):
+        # One (date x country) matrix per metric, so every country is done at once
+        metrics = list(METRIC_COLUMNS.values())
+        countries = ts_df.pivot_table(index="Date", columns="Country", values=metrics, aggfunc="sum", observed=True, dropna=False)
+        countries.columns = countries.columns.set_names(["Metric", "Country"])
+        return countries
+
+    def _index(self):
+        metrics = list(METRIC_COLUMNS.values())
+        totals = self.countries[""]
+        self.country_totals = {metric: totals[metric].to_numpy(dtype=float) for metric in metrics}
+        self.country_names = totals[metrics[0]].columns.astype(str)
+
+        self.dates = self.world.index
+        self.positions = {date: i for i, date in enumerate(self.dates)}
+        self.country_positions = {date: i for i, date in enumerate(self.countries.index)}
+
+        # Where each country's numbers sit in a row of the countries table
+        self.country_values = self.countries.to_numpy(dtype=float)
+        self.country_columns = {}
+        for j, (stat, metric, country) in enumerate(self.countries.columns):
+            self.country_columns.setdefault(country, ([], []))
+            self.country_columns[country][0].append(j)
+            self.country_columns[country][1].append(f"{metric} {stat}".strip())
+
+    def extend(self, headline_df, ts_df):
+        # These aggregates with the rows of headline_df and ts_df, all dated
+        # after the ones they were built from, added. Only the new rows are
+        # pivoted, and only the new dates get their stats worked out, from the
+        # WINDOW dates before them. Returns None if the new rows bring in
+        # countries these aggregates don't have, a full build is needed then.
+        metrics = list(METRIC_COLUMNS.values())
+        countries = self._pivot(ts_df)
+        if not countries.columns.isin(self.countries[""].columns).all():
+            return None
+
+        extended = DailyAggregates.__new__(DailyAggregates)
+        extended.world = self._extend_stats(self.world, self.world[metrics], headline_df.set_index("Date")[metrics])
+        extended.countries = self._extend_stats(self.countries, self.countries[""], countries)
+        extended._index()
+        return extended
+
+    @classmethod
+    def _extend_stats(cls, stats, totals, new):
+        # stats, worked out from totals, with the rows for the new totals
+        # added. Their stats only need the WINDOW rows before them, and are
+        # worked out with whole-array operations over just those rows.
+        if len(new) == 0:
+            return stats
+        new = new.reindex(columns=totals.columns)
+        values = np.concatenate([totals.iloc[-cls.WINDOW:].to_numpy(dtype=float), new.to_numpy(dtype=float)])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = np.concatenate([np.full((1, values.shape[1]), np.nan), np.diff(values, axis=0)])
+            growth = values[1:] / values[:-1] - 1
+            windows = np.lib.stride_tricks.sliding_window_view(
+                np.concatenate([np.full((cls.WINDOW - 1, values.shape[1]), np.nan), change]), cls.WINDOW, axis=0
+            )
+            average = np.nansum(windows, axis=-1) / (~np.isnan(windows)).sum(axis=-1)
+
+        n = len(new)
+        added = pd.DataFrame(
+            np.hstack([change[-n:], growth[-n:], average[-n:]]),
+            index=new.index, columns=stats.columns[len(totals.columns):]
+        )
+        added = pd.concat([new.set_axis(stats.columns[:len(totals.columns)], axis=1), added], axis=1)
+        return pd.concat([stats, added])
+
+    @classmethod
+    def _with_stats(cls, totals):
+        change = totals.diff()
+        stats = [
+            totals,
+            change,
+            totals / totals.shift() - 1,
+            change.rolling(cls.WINDOW, min_periods=1).mean(),
+        ]
+        names = ("",) + cls.STATS
+        if isinstance(totals.columns, pd.MultiIndex):
+            return pd.concat(stats, axis=1, keys=names, names=["Stat"])
+        for df, name in zip(stats, names):
+            df.columns = [f"{column} {name}".strip() for column in totals.columns]
+        return pd.concat(stats, axis=1)
+
+    def on(self, date=None, country=None):
+        # All the numbers for a date (the latest by default), worldwide or for
+        # one country, as a dict of "Confirmed", "Confirmed change", ... values
+        if country is None:
+            i = len(self.world) - 1 if date is None else self.positions[pd.Timestamp(date)]
+            return {column: self.world[column].iat[i] for column in self.world.columns}
+
+        i = len(self.countries) - 1 if date is None else self.country_positions[pd.Timestamp(date)]
+        columns, names = self.country_columns[country]
+        return dict(zip(names, self.country_values[i, columns]))
+
+
+class DeathRateRanking:
+    # Ranks countries by death rate on a date using the per-country totals in
+    # DailyAggregates: thresholds are boolean masks over the country arrays,
+    # and the top rows are picked with a partial sort. Results are cached per
+    # (date, min_cases, min_deaths, max_rows), so changing the thresholds
+    # interactively only costs one pass over the countries for a new combination.
+    AVERAGE = "Average"
+
+    def __init__(self, aggregates, cache_size=256):
+        self.aggregates = aggregates
+        self._rank = functools.lru_cache(maxsize=cache_size)(self._compute)
+
+    def rank(self, date=None, min_cases=15000, min_deaths=525, max_rows=30):
+        # A frame of Country, Rate, Cases and Deaths, highest rate first, of the
+        # countries above both thresholds plus the average over all countries.
+        # A date without data of its own gets the latest numbers before it.
+        dates = self.aggregates.countries.index
+        if not date:
+            date = dates[-1]
+        else:
+            i = dates.searchsorted(pd.Timestamp(date), side="right") - 1
+            if i < 0:
+                raise ValueError(f"No data on or before {pd.Timestamp(date):%Y-%m-%d}, it starts on {dates[0]:%Y-%m-%d}")
+            date = dates[i]
+        return self._rank(date, min_cases, min_deaths, max_rows)
+
+    def _compute(self, date, min_cases, min_deaths, max_rows):
+        i = self.aggregates.country_positions[date]
+        cases = np.nan_to_num(self.aggregates.country_totals["Confirmed"][i])
+        deaths = np.nan_to_num(self.aggregates.country_totals["Deaths"][i])
+
+        mask = (np.maximum(cases, 1) > min_cases) & (deaths > min_deaths)
+        names = np.append(self.aggregates.country_names[mask], self.AVERAGE)
+        cases = np.append(cases[mask], cases.sum())
+        deaths = np.append(deaths[mask], deaths.sum())
+        rates = deaths / np.maximum(cases, 1)
+
+        # Only the top max_rows need sorting
+        if len(rates) > max_rows:
+            top = np.argpartition(-rates, max_rows - 1)[:max_rows]
+        else:
+            top = np.arange(len(rates))
+        top = top[np.argsort(-rates[top], kind="mergesort")]
+
+        return pd.DataFrame({
+            "Country": names[top],
+            "Rate": rates[top],
+            "Cases": cases[top].astype(np.int64),
+            "Deaths": deaths[top].astype(np.int64),
+        })
+
+
+class AlignedSeries:
+    # Every country's numbers lined up by days since it reached a threshold,
+    # as one (day x country) matrix per metric and threshold, built from the
+    # (date x country) totals of DailyAggregates. Day 0 of a column is the
+    # first date the country's number reached the threshold, so a selection
+    # of countries is a gather of columns rather than a search of the rows
+    # for each one. Matrices are kept for the cache_size most recently used
+    # (metric, threshold) pairs, and built up front for the threshold of 1.
+    def __init__(self, aggregates, cache_size=32):
+        self.totals = aggregates.country_totals
+        self.countries = aggregates.country_names
+        self.positions = {country: i for i, country in enumerate(self.countries)}
+        self._aligned = functools.lru_cache(maxsize=cache_size)(self._compute)
+        for metric in self.totals:
+            self.aligned(metric, 1)
+
+    def aligned(self, metric="Confirmed", threshold=1):
+        # The (day x country) matrix, NaN past each country's last date, and
+        # the number of days each country has since reaching the threshold
+        return self._aligned(metric, threshold)
+
+    def _compute(self, metric, threshold):
+        totals = self.totals[metric]
+        days = len(totals)
+        running_max = np.maximum.accumulate(np.nan_to_num(totals, nan=-np.inf), axis=0)
+        reached = running_max >= threshold
+        first = np.where(reached.any(axis=0), reached.argmax(axis=0), days)
+
+        rows = first + np.arange(days)[:, None]
+        matrix = np.where(
+            rows < days,
+            totals[np.minimum(rows, days - 1), np.arange(totals.shape[1])],
+            np.nan
+        )
+        return matrix, days - first
+
+    def gather(self, countries, metric="Confirmed", threshold=1):
+        # (country, values) for each of countries that has reached the
+        # threshold, in the order given
+        countries = [country for country in countries if country in self.positions]
+        columns = np.array([self.positions[country] for country in countries], dtype=np.int64)
+        matrix, lengths = self.aligned(metric, threshold)
+        selected = matrix[:, columns]
+        return [
+            (country, selected[:lengths[column], j])
+            for j, (country, column) in enumerate(zip(countries, columns))
+            if lengths[column] > 0
+        ]
+
+
+# Continents by ISO 3166 alpha-2 country code (UN geoscheme, with the
+# Americas split in two). Locations without a code, like cruise ships, are "Other".
+CONTINENT_CODES = {
+    "Africa": "AO BF BI BJ BW CD CF CG CI CM CV DJ DZ EG EH ER ET GA GH GM GN GQ GW KE KM LR LS LY MA MG "
+              "ML MR MU MW MZ NA NE NG RE RW SC SD SH SL SN SO SS ST SZ TD TG TN TZ UG YT ZA ZM ZW",
+    "Asia": "AE AF AM AZ BD BH BN BT CN CY GE HK ID IL IN IQ IR JO JP KG KH KP KR KW KZ LA LB LK MM MN MO "
+            "MV MY NP OM PH PK PS QA SA SG SY TH TJ TL TM TR TW UZ VN YE",
+    "Europe": "AD AL AT AX BA BE BG BY CH CZ DE DK EE ES FI FO FR GB GG GI GR HR HU IE IM IS IT JE LI LT LU "
+              "LV MC MD ME MK MT NL NO PL PT RO RS RU SE SI SJ SK SM UA VA XK",
+    "North America": "AG AI AW BB BL BM BQ BS BZ CA CR CU CW DM DO GD GL GP GT HN HT JM KN KY LC MF MQ MS MX "
+                     "NI PA PM PR SV SX TC TT US VC VG VI",
+    "South America": "AR BO BR CL CO EC FK GF GY PE PY SR UY VE",
+    "Oceania": "AS AU CK FJ FM GU KI MH MP NC NF NR NU NZ PF PG PN PW SB TK TO TV VU WF WS",
+}
+CONTINENTS = {code: continent for continent, codes in CONTINENT_CODES.items() for code in codes.split()}
+OTHER_CONTINENT = "Other"
+
+
+class ReferenceIndex:
+    # The reference table as arrays by Combined_Key: population, coordinates
+    # and where each location sits in the province -> country -> continent
+    # hierarchy. Looking a location up is a dict lookup instead of a scan.
+    def __init__(self, ref):
+        ref = ref.assign(Combined_Key=ref["Combined_Key"].astype(str)).drop_duplicates("Combined_Key")
+        self.keys = ref["Combined_Key"].values
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+
+        self.population = pd.to_numeric(ref["Population"], errors="coerce").to_numpy(dtype=float)
+        self.lat = pd.to_numeric(ref["Lat"], errors="coerce").to_numpy(dtype=float)
+        self.long = pd.to_numeric(ref["Long_"], errors="coerce").to_numpy(dtype=float)
+        self.coordinates = coordinates(ref)
+
+        province = ref["Province_State"].astype(object)
+        self.province = province.where(province.notna(), None).values
+        self.country = ref["Country_Region"].astype(str).values
+        self.continent = ref["iso2"].astype(object).map(CONTINENTS).fillna(OTHER_CONTINENT).values
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def population_of(self, key):
+        # The population of one location, or None if it isn't known
+        i = self.positions.get(key)
+        if i is None or np.isnan(self.population[i]):
+            return None
+        return self.population[i]
+
+
+# DataTable filter_query operators, as written in the query, by the name used below
+FILTER_OPERATORS = [
+    ("ge", ("ge ", ">=")),
+    ("le", ("le ", "<=")),
+    ("lt", ("lt ", "<")),
+    ("gt", ("gt ", ">")),
+    ("ne", ("ne ", "!=")),
+    ("eq", ("eq ", "=")),
+    ("contains", ("contains ",)),
+    ("datestartswith", ("datestartswith ",)),
+]
+
+
+def parse_filter(filter_query):
+    # Clauses of a DataTable filter_query as (column, operator, value) tuples.
+    # The operator is whatever follows the {column}, so operators inside the
+    # value (like the "le " in "Isle ") aren't mistaken for it.
+    clauses = []
+    for part in (filter_query or "").split(" && "):
+        part = part.strip()
+        close = part.find("}")
+        if not part.startswith("{") or close < 0:
+            continue
+        column = part[1:close]
+        rest = part[close + 1:].lstrip()
+
+        for name, aliases in FILTER_OPERATORS:
+            alias = next((alias for alias in aliases if rest.startswith(alias)), None)
+            if alias is None:
+                continue
+
+            value = rest[len(alias):].strip()
+            if len(value) > 1 and value[0] == value[-1] and value[0] in ("'", '"', "`"):
+                value = value[1:-1].replace("\\" + value[0], value[0])
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            clauses.append((column, name, value))
+            break
+    return clauses
+
+
+class TableIndex:
+    # Server-side paging, sorting and filtering for a DataTable. Every column
+    # is sorted once up front, so a page request never sorts: numeric filters
+    # are binary searches on the presorted values, and a page is a slice of a
+    # presorted order. Only the rows of the requested page are turned into records.
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+        self.orders = {}
+        self.sorted_values = {}
+        # How many of a numeric column's sorted values aren't NaN (which sort last)
+        self.valid = {}
+        for column in self.df.columns:
+            if pd.api.types.is_numeric_dtype(self.df[column]):
+                values = self.df[column].to_numpy()
+            else:
+                values = self.df[column].astype(str).to_numpy(dtype=object)
+            self.orders[column] = np.argsort(values, kind="mergesort")
+            self.sorted_values[column] = values[self.orders[column]]
+            if pd.api.types.is_numeric_dtype(self.df[column]):
+                self.valid[column] = int(np.count_nonzero(~pd.isna(values)))
+
+    def _clause_mask(self, column, operator, value):
+        values = self.df[column]
+        numeric = pd.api.types.is_numeric_dtype(values)
+
+        if numeric and isinstance(value, float) and operator in ("gt", "ge", "lt", "le", "eq", "ne"):
+            # NaN doesn't compare to anything, so only the values before it are searched
+            valid = self.valid[column]
+            sorted_values = self.sorted_values[column][:valid]
+            low, high = 0, valid
+            if operator in ("gt", "ge"):
+                low = np.searchsorted(sorted_values, value, side="right" if operator == "gt" else "left")
+            elif operator in ("lt", "le"):
+                high = np.searchsorted(sorted_values, value, side="left" if operator == "lt" else "right")
+            else:
+                low = np.searchsorted(sorted_values, value, side="left")
+                high = np.searchsorted(sorted_values, value, side="right")
+            mask = np.zeros(len(self.df), dtype=bool)
+            if operator == "ne":
+                mask[self.orders[column][:valid]] = True
+                mask[self.orders[column][low:high]] = False
+            else:
+                mask[self.orders[column][low:high]] = True
+            return mask
+
+        text = values.astype(str)
+        value = str(value)
+        if operator == "contains":
+            return text.str.contains(value, case=False, regex=False).values
+        if operator == "datestartswith":
+            return text.str.startswith(value).values
+        if operator == "eq":
+            return (text == value).values
+        if operator == "ne":
+            return (text != value).values
+        # Comparisons on text columns compare as text
+        return {"gt": text > value, "ge": text >= value, "lt": text < value, "le": text <= value}[operator].values
+
+    def page(self, page_current=0, page_size=10, sort_by=None, filter_query=""):
+        # The records on one page and the number of pages, after filtering and sorting
+        if sort_by and sort_by[0]["column_id"] in self.orders:
+            column = sort_by[0]["column_id"]
+            order = self.orders[column]
+            if sort_by[0]["direction"] == "desc":
+                # Missing values stay last either way, like the table's own sorting
+                valid = self.valid.get(column, len(order))
+                order = np.concatenate([order[:valid][::-1], order[valid:]])
+        else:
+            order = np.arange(len(self.df))
+
+        clauses = [clause for clause in parse_filter(filter_query) if clause[0] in self.orders]
+        if clauses:
+            mask = np.ones(len(self.df), dtype=bool)
+            for clause in clauses:
+                mask &= self._clause_mask(*clause)
+            order = order[mask[order]]
+
+        page_count = max(1, -(-len(order) // page_size))
+        rows = order[page_current * page_size:(page_current + 1) * page_size]
+        return self.df.iloc[rows].to_dict("records"), page_count
+
+
+# Long time series are cut down to about as many points as the chart has
+# pixels across before they're sent, with the Largest-Triangle-Three-Buckets
+# algorithm, which keeps the points that shape the line. Zooming in fetches
+# the zoomed window again, which has fewer points to cut down, so the detail
+# comes back as the user zooms.
+MIN_POINTS = 64
+MAX_POINTS = 4096
+
+
+def max_points_for_width(width):
+    # Points per trace for a chart width in pixels, rounded up to a power of
+    # two so that similar screens share cached figures
+    points = min(MAX_POINTS, max(MIN_POINTS, int(width)))
+    return 1 << (points - 1).bit_length()
+
+
+def _axis_values(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype("datetime64[ns]").astype(np.int64)
+    return x.astype(float)
+
+
+def lttb(x, y, threshold):
+    # Indices of the threshold points of (x, y) that best keep its shape. The
+    # first and last points are always kept, and one point from each of the
+    # buckets in between: the one making the largest triangle with the point
+    # kept from the previous bucket and the average of the next one.
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = _axis_values(x)
+    y = np.asarray(y, dtype=float)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    edges = np.append(edges, n)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2]
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def decimate(x, y, max_points=None, x_range=None):
+    # Indices of the points of a trace to send: those within x_range (if
+    # given), cut down to max_points (if given)
+    indices = np.arange(len(y))
+    x = np.asarray(x)
+    if x_range is not None:
+        values = _axis_values(x)
+        low, high = _axis_values(np.asarray(x_range, dtype=x.dtype))
+        indices = indices[(values >= low) & (values <= high)]
+    if max_points and len(indices) > max_points:
+        indices = indices[lttb(x[indices], np.asarray(y)[indices], max_points)]
+    return indices
+
+
+def zoom_range(relayout_data, dates=False):
+    # The x range to send for a graph's relayoutData, as (changed, x_range).
+    # A zoom or pan gives the visible range widened by its own width on each
+    # side, so panning a little doesn't run off the end of the data, and
+    # rounded out to whole days so that nearby zooms share cached figures.
+    # Zooming back out (or no relayout yet) gives None, for the whole range.
+    # Relayouts that don't touch the x axis don't change what's sent.
+    relayout_data = relayout_data or {}
+    if "xaxis.range[0]" in relayout_data and "xaxis.range[1]" in relayout_data:
+        low, high = relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]
+    elif "xaxis.range" in relayout_data:
+        low, high = relayout_data["xaxis.range"][:2]
+    elif not relayout_data or "xaxis.autorange" in relayout_data:
+        return True, None
     else:
-        raise ValueError("'data' variable must be equal to 'cases', 'recoveries' or 'deaths'")
+        return False, None
 
-    for i in range(len(country_df)):
-        if country_df.iloc[i][j] >= x:
-            return country_df.iloc[i][0]
-    return False
+    if dates:
+        low, high = pd.Timestamp(low), pd.Timestamp(high)
+        width = high - low
+        return True, [
+            f"{(low - width).floor('D'):%Y-%m-%d}",
+            f"{(high + width).ceil('D'):%Y-%m-%d}",
+        ]
+    low, high = float(low), float(high)
+    width = high - low
+    return True, [int(np.floor(low - width)), int(np.ceil(high + width))]
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import bisect
+import functools
+import threading
+from collections import Counter
+
+import flask
+
+from data import CACHE_DIR
+
+# Latency and size metrics, exposed in the Prometheus text format on /metrics.
+# Metrics live in each process, so with several gunicorn workers a scrape sees
+# whichever worker answers it; the pid label tells them apart.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+_registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels) + ('pid',)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels[:-1]) + (str(os.getpid()),)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.series.items())
+        for key, (counts, total, count) in series:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', repr(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return '\n'.join(lines)
+
+
+class _Timer:
+    # Observes the time spent in a with block, or in every call of a decorated function
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def render():
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'covid_request_duration_seconds', "Time spent handling HTTP requests", ('endpoint', 'method', 'status'))
+CALLBACK_SECONDS = Histogram(
+    'covid_callback_duration_seconds', "Time spent handling Dash callback requests, by callback output", ('callback',))
+CALLBACK_BYTES = Histogram(
+    'covid_callback_response_bytes', "Size of serialized Dash callback responses before compression",
+    ('callback',), SIZE_BUCKETS)
+FIGURE_SECONDS = Histogram(
+    'covid_figure_build_seconds', "Time spent building and serializing figures that weren't cached", ('figure',))
+FIGURE_BYTES = Histogram(
+    'covid_figure_bytes', "Size of serialized figures", ('figure',), SIZE_BUCKETS)
+DATA_LOAD_SECONDS = Histogram(
+    'covid_data_load_seconds', "Time spent fetching, parsing and loading data, by step", ('step',),
+    LATENCY_BUCKETS + (120, 300))
+
+
+# Opt-in sampling profiler. When PROFILE_SLOW is set (in seconds), the stack of
+# every request thread is sampled every PROFILE_INTERVAL seconds, and requests
+# slower than PROFILE_SLOW have their samples written to PROFILE_DIR as folded
+# stacks, which flamegraph.pl or speedscope turn into a flame graph.
+PROFILE_SLOW = float(os.environ.get('COVID_PROFILE_SLOW', 0))
+PROFILE_INTERVAL = float(os.environ.get('COVID_PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('COVID_PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+
+
+def _folded_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, thread_id=None):
+        with self.lock:
+            self.samples[thread_id or threading.get_ident()] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self.thread.start()
+
+    def stop(self, thread_id=None):
+        # The samples taken since start(), as a Counter of folded stacks
+        with self.lock:
+            return self.samples.pop(thread_id or threading.get_ident(), Counter())
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, samples in self.samples.items():
+                    if thread_id != me and thread_id in frames:
+                        samples[_folded_stack(frames[thread_id])] += 1
+
+
+def dump_profile(samples, label, directory=PROFILE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    safe_label = ''.join(c if c.isalnum() or c in '-_' else '_' for c in label)[:80]
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe_label}.folded")
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+def instrument(server, profile_slow=PROFILE_SLOW):
+    # Time every request to server, and every Dash callback request by the
+    # output it's for, and serve the metrics on /metrics
+    profiler = SamplingProfiler() if profile_slow > 0 else None
+
+    @server.before_request
+    def start_timer():
+        flask.g.request_start = time.perf_counter()
+        if profiler is not None:
+            profiler.start()
+
+    @server.after_request
+    def record_request(response):
+        if 'request_start' not in flask.g:
+            return response
+        duration = time.perf_counter() - flask.g.request_start
+
+        REQUEST_SECONDS.observe(
+            duration, endpoint=flask.request.endpoint or '', method=flask.request.method, status=response.status_code)
+
+        label = None
+        if flask.request.path.endswith('_dash-update-component'):
+            label = (flask.request.get_json(silent=True) or {}).get('output', '')
+            CALLBACK_SECONDS.observe(duration, callback=label)
+            size = flask.g.get('serialized_bytes')
+            if size is None and not response.direct_passthrough and 'Content-Encoding' not in response.headers:
+                size = response.content_length
+            if size is not None:
+                CALLBACK_BYTES.observe(size, callback=label)
+
+        if profiler is not None:
+            samples = profiler.stop()
+            if duration >= profile_slow and samples:
+                dump_profile(samples, label or flask.request.endpoint or flask.request.path)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,57 @@
+import os
+import logging
+import threading
+
+from snapshot import load_or_build
+
+from metrics import DATA_LOAD_SECONDS
+
+from dataset import (
+    Dataset,
+    current_dataset
+)
+
+# How often (in seconds) each worker checks for new data. 0 disables refreshing.
+REFRESH_INTERVAL = int(os.environ.get('COVID_REFRESH_INTERVAL', 15 * 60))
+
+
+class Refresher(threading.Thread):
+    # Reloads the data in the background every interval seconds. Whenever the
+    # data version changes, the new dataset is handed to install(), which
+    # builds anything derived from it and swaps it in, all off the request path.
+    def __init__(self, install, interval=REFRESH_INTERVAL, load=load_or_build):
+        super().__init__(name="data-refresher", daemon=True)
+        self.install = install
+        self.interval = interval
+        self.load = load
+        self.stopped = threading.Event()
+
+    @DATA_LOAD_SECONDS.time(step='refresh')
+    def refresh(self):
+        # The snapshot's frames are only loaded if its version is new to us
+        current = current_dataset()
+        frames, meta = self.load(current_version=current.version if current is not None else None)
+        if frames is None:
+            return False
+
+        logging.info(f"Installing data version {meta['version']}")
+        self.install(Dataset(frames, meta, previous=current))
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Data refresh failed, keeping the current data")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_refresher(install, interval=REFRESH_INTERVAL):
+    if interval <= 0:
+        return None
+    refresher = Refresher(install, interval)
+    refresher.start()
+    return refresher
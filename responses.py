@@ -0,0 +1,92 @@
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses that only change with the data are serialized and compressed once
+# per data version, then served as-is. Each encoding gets its own strong ETag,
+# so browsers and caches in front of the app can revalidate with a 304.
+GZIP_LEVEL = int(os.environ.get('COVID_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COVID_BROTLI_QUALITY', 9))
+RESPONSE_CACHE_SIZE = int(os.environ.get('COVID_RESPONSE_CACHE_SIZE', 256))
+
+
+class CompressedPayload:
+    def __init__(self, body, mimetype='application/json'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+
+        tag = hashlib.sha1(body).hexdigest()[:20]
+        self.variants = {'identity': (body, tag)}
+        self.variants['gzip'] = (gzip.compress(body, GZIP_LEVEL), f"{tag}-gz")
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body, quality=BROTLI_QUALITY), f"{tag}-br")
+
+    def encoding_for(self, request):
+        # Prefer the smallest variant the client says it can take
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and request.accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+    def response(self, request, cache_control='no-cache'):
+        encoding = self.encoding_for(request)
+        body, etag = self.variants[encoding]
+
+        # Any variant the client already holds is still current
+        for _, held in self.variants.values():
+            if request.if_none_match.contains_weak(held):
+                response = flask.Response(status=304)
+                response.set_etag(held)
+                break
+        else:
+            response = flask.Response(body, mimetype=self.mimetype)
+            response.set_etag(etag)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+
+class ResponseCache:
+    # Payloads for the current data version, up to size of the most recently
+    # used. Moving to a new version drops everything built for the old one.
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.version = None
+        self.payloads = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, key, build):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.payloads = OrderedDict()
+            payload = self.payloads.get(key)
+            if payload is not None:
+                self.payloads.move_to_end(key)
+                return payload
+
+        payload = CompressedPayload(build())
+        with self.lock:
+            if version == self.version:
+                self.payloads[key] = payload
+                while len(self.payloads) > self.size:
+                    self.payloads.popitem(last=False)
+        return payload
+
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.payloads = OrderedDict()
@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import fcntl
+import logging
+import contextlib
+import numpy as np
+import pandas as pd
+
+from data import (
+    DATA_SOURCE,
+    CACHE_DIR,
+    FRAME_RESOURCES,
+    df_from_path,
+    df_after,
+    _write_atomic
+)
+
+from async_data import (
+    load_frames,
+    refresh_resources
+)
+
+from metrics import DATA_LOAD_SECONDS
+
+from helpers import index_by_date
+
+# The parsed frames are stored as one raw file per column so that workers can
+# memory-map them instead of re-parsing the CSV/JSON resources on every boot.
+# Each build goes into its own versioned directory and CURRENT points at the
+# latest one, so a reader never sees a half-written snapshot.
+SNAPSHOT_DIR = os.environ.get('COVID_SNAPSHOT_DIR', os.path.join(CACHE_DIR, 'snapshot'))
+SNAPSHOT_MAX_AGE = int(os.environ.get('COVID_SNAPSHOT_MAX_AGE', 60 * 60))
+SNAPSHOTS_KEPT = 2
+# Bumped whenever the files change layout, so older snapshots get rebuilt
+SNAPSHOT_FORMAT = 2
+
+# With incremental ingestion, a stale snapshot is brought up to date by parsing
+# only the rows dated after it instead of rebuilding it from scratch. Upstream
+# sometimes revises older numbers in place, which appending can't see, so the
+# snapshot is still rebuilt from scratch once it's FULL_REBUILD_AGE old.
+INCREMENTAL = os.environ.get('COVID_INCREMENTAL', '1') not in ('', '0')
+FULL_REBUILD_AGE = int(os.environ.get('COVID_FULL_REBUILD_AGE', 24 * 60 * 60))
+
+DATE_COLUMNS = ('Date',)
+# Float columns that only hold whole numbers, read as floats because of gaps
+COUNT_COLUMNS = ('Confirmed', 'Recovered', 'Deaths', 'Population')
+DATED_FRAMES = ('headline_df', 'ts_df', 'df2')
+# The location column of each per-location frame. Their rows are stored in
+# (date, location) order, the order the dashboard indexes them in, so loading
+# them doesn't need a sorted copy.
+LOCATION_COLUMNS = {'ts_df': 'Country', 'df2': 'Country/Region'}
+
+
+def downcast_counts(series):
+    # Store integer columns, and count columns that only hold whole numbers,
+    # in the smallest signed integer type that holds them. Signed, so that
+    # differences between days still fit. Counts with gaps are left as floats.
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_float_dtype(series) and series.name in COUNT_COLUMNS:
+        values = series.values
+        if len(values) == 0 or np.isnan(values).any() or not (values == np.round(values)).all():
+            return series
+        series = series.astype(np.int64)
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    return series
+
+
+def normalize_frame(df):
+    # Give every column its most compact proper type: datetime64 dates,
+    # categorical strings and the smallest integer type for counts
+    df = df.copy()
+    for column in df.columns:
+        if column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column])
+        elif pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            df[column] = df[column].astype('category')
+        else:
+            df[column] = downcast_counts(df[column])
+    return df
+
+
+def sort_frame(name, df):
+    # Put a frame's rows in the order they're stored in (see LOCATION_COLUMNS)
+    if name not in LOCATION_COLUMNS:
+        return df
+    return index_by_date(df, LOCATION_COLUMNS[name]).reset_index(drop=True)
+
+
+def frames_version(frames):
+    # A stamp that only changes when the contents of the frames change
+    h = hashlib.sha1()
+    for name in sorted(frames):
+        h.update(name.encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(frames[name], index=False).values.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _is_categorical(series):
+    return isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def _column_to_array(series):
+    if _is_categorical(series):
+        return series.cat.codes.values, {
+            'kind': 'category',
+            'categories': series.cat.categories.tolist(),
+        }
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.values.astype('datetime64[ns]'), {'kind': 'datetime'}
+    return series.values, {'kind': 'numeric'}
+
+
+def _new_values(info, series):
+    # The values of series encoded like the stored column described by info:
+    # categories seen for the first time go at the end, so old codes stay valid
+    if info['kind'] == 'category':
+        values = series.astype(object)
+        categories = pd.Index(info['categories'], dtype=object)
+        categories = categories.append(pd.Index(values.dropna().unique()).difference(categories))
+        return categories.get_indexer(values), dict(info, categories=categories.tolist())
+    if info['kind'] == 'datetime':
+        return pd.to_datetime(series).values.astype('datetime64[ns]'), info
+    return pd.to_numeric(series).values, info
+
+
+def _column_path(directory, name, i):
+    return os.path.join(directory, f"{name}.{i}.bin")
+
+
+def _write_column(path, array):
+    with open(path, 'wb') as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def _map_column(path, dtype, rows):
+    if rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
+
+def _append_column(old_path, new_path, info, rows, series):
+    # Write a column holding the rows of old_path followed by series to
+    # new_path, and return its info. The old file is hard-linked and only the
+    # new values are written, at its end: readers of the old version map just
+    # its first rows, so they don't see them. If the old file already has rows
+    # past those (it was appended to since) or the new values don't fit its
+    # type, the whole column is rewritten instead.
+    values, info = _new_values(info, series)
+    dtype = np.dtype(info['dtype'])
+    with np.errstate(invalid='ignore'):
+        stored = values.astype(dtype)
+    if os.path.getsize(old_path) == rows * dtype.itemsize and np.array_equal(stored, values, equal_nan=True):
+        os.link(old_path, new_path)
+        with open(new_path, 'ab') as f:
+            f.write(stored.tobytes())
+        return info
+    array = np.concatenate([_map_column(old_path, dtype, rows), values])
+    _write_column(new_path, array)
+    return dict(info, dtype=array.dtype.str)
+
+
+def _column_from_array(array, info):
+    if info['kind'] == 'category':
+        return pd.Categorical.from_codes(array, categories=info['categories'])
+    return array
+
+
+def _commit(path, tmp, meta):
+    # Publish a snapshot written to tmp as the current one
+    target = os.path.join(path, meta['version'])
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Another process built the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    _write_atomic(os.path.join(path, 'CURRENT'), meta['version'].encode('utf-8'))
+    _prune(path, keep=meta['version'])
+
+
+def _mark_fresh(path, version):
+    # Same data as before, just mark it as checked now so it counts as fresh
+    meta_path = os.path.join(path, version, 'meta.json')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['built'] = time.time()
+    _write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+    _write_atomic(os.path.join(path, 'CURRENT'), version.encode('utf-8'))
+    _prune(path, keep=version)
+
+
+def _temp_dir(path, version):
+    tmp = f"{os.path.join(path, version)}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    return tmp
+
+
+def _write_frame(directory, name, df):
+    columns = []
+    for i, column in enumerate(df.columns):
+        array, info = _column_to_array(df[column])
+        _write_column(_column_path(directory, name, i), array)
+        info.update(name=column, dtype=array.dtype.str)
+        columns.append(info)
+    return {'rows': len(df), 'columns': columns}
+
+
+def write_snapshot(frames, path=SNAPSHOT_DIR, version=None, **extra):
+    version = version or frames_version(frames)
+    if os.path.exists(os.path.join(path, version)):
+        _mark_fresh(path, version)
+        return version
+
+    tmp = _temp_dir(path, version)
+    meta = dict(extra, format=SNAPSHOT_FORMAT, version=version, built=time.time(), frames={})
+    for name, df in frames.items():
+        meta['frames'][name] = _write_frame(tmp, name, df)
+    _commit(path, tmp, meta)
+    return version
+
+
+def write_appended_snapshot(old_meta, new_rows, replaced, path=SNAPSHOT_DIR, version=None, **extra):
+    # Write a snapshot that holds the one described by old_meta with the rows
+    # of new_rows added at their end and the replaced frames
+    # swapped in whole. Of the rest only the new rows are written, see
+    # _append_column; frames without new rows are hard-linked as they are.
+    if os.path.exists(os.path.join(path, version)):
+        _mark_fresh(path, version)
+        return version
+
+    tmp = _temp_dir(path, version)
+    directory = os.path.join(path, old_meta['version'])
+    meta = dict(extra, format=SNAPSHOT_FORMAT, version=version, built=time.time(), frames={})
+    for name, frame in old_meta['frames'].items():
+        if name in replaced:
+            meta['frames'][name] = _write_frame(tmp, name, replaced[name])
+            continue
+        rows = frame['rows']
+        new = new_rows.get(name)
+        if new is not None:
+            new = new.reindex(columns=[info['name'] for info in frame['columns']])
+        columns = []
+        for i, info in enumerate(frame['columns']):
+            old_path, new_path = _column_path(directory, name, i), _column_path(tmp, name, i)
+            if new is None or len(new) == 0:
+                os.link(old_path, new_path)
+            else:
+                info = _append_column(old_path, new_path, info, rows, new[info['name']])
+            columns.append(info)
+        meta['frames'][name] = {'rows': rows + (0 if new is None else len(new)), 'columns': columns}
+    _commit(path, tmp, meta)
+    return version
+
+
+def _prune(path, keep):
+    builds = [
+        os.path.join(path, d) for d in os.listdir(path)
+        if os.path.isdir(os.path.join(path, d)) and not d.endswith('.tmp')
+    ]
+    builds.sort(key=os.path.getmtime, reverse=True)
+    for old in builds[SNAPSHOTS_KEPT:]:
+        if os.path.basename(old) != keep:
+            # Workers still mapping these files keep their pages until they let go
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def read_meta(path=SNAPSHOT_DIR):
+    # Return the meta of the current snapshot, or None if there isn't one
+    try:
+        with open(os.path.join(path, 'CURRENT')) as f:
+            version = f.read().strip()
+        with open(os.path.join(path, version, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format') == SNAPSHOT_FORMAT else None
+
+
+@DATA_LOAD_SECONDS.time(step='load_snapshot')
+def load_snapshot(path=SNAPSHOT_DIR, meta=None):
+    meta = meta or read_meta(path)
+    if meta is None:
+        raise FileNotFoundError(f"No snapshot found in {path}")
+
+    # Every column stays a view of its memory-mapped file: copy=False keeps
+    # pandas from copying the columns into blocks of its own, so the pages are
+    # shared through the page cache by every process that loads the snapshot
+    directory = os.path.join(path, meta['version'])
+    frames = {}
+    for name, frame in meta['frames'].items():
+        data = {}
+        for i, info in enumerate(frame['columns']):
+            array = _map_column(_column_path(directory, name, i), info['dtype'], frame['rows'])
+            data[info['name']] = _column_from_array(array, info)
+        frames[name] = pd.DataFrame(data, columns=[c['name'] for c in frame['columns']], copy=False)
+    return frames, meta
+
+
+@DATA_LOAD_SECONDS.time(step='build_snapshot')
+def build_snapshot(url=DATA_SOURCE, path=SNAPSHOT_DIR):
+    frames = {name: sort_frame(name, normalize_frame(df)) for name, df in load_frames(url).items()}
+    write_snapshot(frames, path)
+    return load_snapshot(path)
+
+
+@DATA_LOAD_SECONDS.time(step='append_snapshot')
+def append_snapshot(url=DATA_SOURCE, path=SNAPSHOT_DIR):
+    # Bring the current snapshot up to date with the rows dated after it. Only
+    # those rows are parsed and only they are written, so this costs about as
+    # much as the new rows, not as the whole history. Falls back to a full
+    # build if upstream revised older rows.
+    meta = read_meta(path)
+    if time.time() - meta.get('base_built', meta['built']) > FULL_REBUILD_AGE:
+        return build_snapshot(url, path)
+    frames, meta = load_snapshot(path, meta)
+    resources, _ = refresh_resources(url)
+
+    new_rows = {}
+    h = hashlib.sha1(meta['version'].encode('utf-8'))
+    for name in DATED_FRAMES:
+        old = frames[name]
+        new = df_after(resources[FRAME_RESOURCES[name]], old['Date'].max(), len(old), offline=True)
+        if new is None:
+            logging.info(f"{FRAME_RESOURCES[name]} has revised history, rebuilding the snapshot")
+            return build_snapshot(url, path)
+        if len(new):
+            new_rows[name] = sort_frame(name, normalize_frame(new))
+            h.update(name.encode('utf-8'))
+            h.update(pd.util.hash_pandas_object(new, index=False).values.tobytes())
+
+    # The reference table isn't dated and is small, so it's simply re-read
+    replaced = {}
+    ref_table = normalize_frame(df_from_path(resources[FRAME_RESOURCES['ref_table']], offline=True))
+    if frames_version({'ref_table': ref_table}) != frames_version({'ref_table': frames['ref_table']}):
+        replaced['ref_table'] = ref_table
+        h.update(frames_version({'ref_table': ref_table}).encode('utf-8'))
+
+    if not new_rows and not replaced:
+        write_snapshot(frames, path, meta['version'])
+        return load_snapshot(path)
+
+    write_appended_snapshot(
+        meta, new_rows, replaced, path, h.hexdigest()[:16],
+        previous=meta['version'],
+        appended={name: len(new_rows.get(name, ())) for name in DATED_FRAMES},
+        base_built=meta.get('base_built', meta['built'])
+    )
+    return load_snapshot(path)
+
+
+@contextlib.contextmanager
+def build_lock(path=SNAPSHOT_DIR):
+    # Only one process rebuilds at a time, the others wait and reuse its result
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_fresh(meta, max_age):
+    return meta is not None and time.time() - meta['built'] < max_age
+
+
+def _load_unless(path, meta, current_version):
+    # The snapshot's frames, or None for them if it's the version we already hold
+    if current_version is not None and meta['version'] == current_version:
+        return None, meta
+    return load_snapshot(path, meta)
+
+
+def load_or_build(url=DATA_SOURCE, path=SNAPSHOT_DIR, max_age=SNAPSHOT_MAX_AGE, current_version=None):
+    # Use the current snapshot while it's fresh, otherwise rebuild it from the
+    # (cached) resources. A stale snapshot is still better than no data at all.
+    # If the snapshot turns out to be current_version, its frames aren't loaded
+    # and (None, meta) is returned.
+    meta = read_meta(path)
+    if _is_fresh(meta, max_age):
+        return _load_unless(path, meta, current_version)
+
+    with build_lock(path):
+        meta = read_meta(path)
+        if _is_fresh(meta, max_age):
+            return _load_unless(path, meta, current_version)
+
+        try:
+            if INCREMENTAL and meta is not None:
+                frames, meta = append_snapshot(url, path)
+            else:
+                frames, meta = build_snapshot(url, path)
+        except Exception as e:
+            if meta is None:
+                raise
+            logging.warning(f"Could not rebuild snapshot ({e}), using the one from {time.ctime(meta['built'])}")
+            return _load_unless(path, meta, current_version)
+        if current_version is not None and meta['version'] == current_version:
+            return None, meta
+        return frames, meta
+
+
+if __name__ == '__main__':
+    frames, meta = build_snapshot(sys.argv[1] if len(sys.argv) > 1 else DATA_SOURCE)
+    print(f"Built snapshot {meta['version']} in {SNAPSHOT_DIR}")
+    for name, df in frames.items():
+        print(f"  {name}: {len(df):,} rows, {len(df.columns)} columns")
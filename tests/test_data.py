@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import threading
+import subprocess
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BODY = b"Date,Confirmed\n2020-01-22,555\n"
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Serves BODY with an ETag, and answers a matching If-None-Match with a 304
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == ETAG:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchPathTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/countries-aggregated.csv"
+        self.cache = tempfile.TemporaryDirectory()
+        self.cache_dir = self.cache.name
+
+    def tearDown(self):
+        self.stop_server()
+        self.cache.cleanup()
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def fetch(self, **kwargs):
+        with open(data.fetch_path(self.url, self.cache_dir, **kwargs), 'rb') as f:
+            return f.read()
+
+    def test_download_then_revalidate(self):
+        self.assertEqual(self.fetch(offline=False), BODY)
+        self.assertEqual(data.read_cached_meta(self.url, self.cache_dir)['etag'], ETAG)
+
+        self.assertEqual(self.fetch(offline=False), BODY)
+        self.assertEqual(self.server.statuses, [200, 304])
+        # Only the body and its metadata are left, no temporary files
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cached_copy_when_server_is_down(self):
+        self.fetch(offline=False)
+        self.stop_server()
+
+        self.assertEqual(self.fetch(offline=False), BODY)
+        with self.assertRaises(requests.RequestException):
+            self.fetch(offline=False, fallback=False)
+
+    def test_no_cached_copy_when_server_is_down(self):
+        self.stop_server()
+        with self.assertRaises(requests.RequestException):
+            self.fetch(offline=False)
+
+    def test_offline(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fetch(offline=True)
+
+        self.fetch(offline=False)
+        self.assertEqual(self.fetch(offline=True), BODY)
+        self.assertEqual(self.server.statuses, [200])
+
+    def test_offline_from_environment(self):
+        self.fetch(offline=False)
+        self.stop_server()
+
+        env = dict(os.environ, COVID_OFFLINE='1', COVID_CACHE_DIR=self.cache_dir)
+        output = subprocess.run(
+            [sys.executable, '-c', f"import sys, data; sys.stdout.buffer.write(data.fetch({self.url!r}))"],
+            cwd=ROOT, env=env, stdout=subprocess.PIPE, check=True
+        ).stdout
+        self.assertEqual(output, BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
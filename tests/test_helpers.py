@@ -0,0 +1,143 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import helpers
+
+
+class ParseFilterTest(unittest.TestCase):
+    def test_operators(self):
+        self.assertEqual(
+            helpers.parse_filter('{Confirmed} >= 5 && {Deaths} ne 3 && {Country} = Italy'),
+            [('Confirmed', 'ge', 5.0), ('Deaths', 'ne', 3.0), ('Country', 'eq', 'Italy')]
+        )
+
+    def test_operator_inside_value(self):
+        # "le " and "ne " in the value aren't operators
+        self.assertEqual(
+            helpers.parse_filter('{Country} contains "Isle " && {Country} contains "Ukraine "'),
+            [('Country', 'contains', 'Isle '), ('Country', 'contains', 'Ukraine ')]
+        )
+
+    def test_empty(self):
+        self.assertEqual(helpers.parse_filter(None), [])
+        self.assertEqual(helpers.parse_filter(''), [])
+
+
+class TableIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = helpers.TableIndex(pd.DataFrame({
+            'Country': ['Isle of Man', 'Albania', 'Belgium', 'Chad', 'Denmark'],
+            'Recovered': [np.nan, 2000, 500, np.nan, 1000],
+        }))
+
+    def countries(self, sort_by=None, filter_query=''):
+        records, _ = self.index.page(0, 10, sort_by, filter_query)
+        return [record['Country'] for record in records]
+
+    def test_numeric_filters_skip_missing_values(self):
+        self.assertEqual(self.countries(filter_query='{Recovered} > 1000'), ['Albania'])
+        self.assertEqual(self.countries(filter_query='{Recovered} >= 1000'), ['Albania', 'Denmark'])
+        self.assertEqual(self.countries(filter_query='{Recovered} < 1000'), ['Belgium'])
+        self.assertEqual(self.countries(filter_query='{Recovered} ne 500'), ['Albania', 'Denmark'])
+        self.assertEqual(self.countries(filter_query='{Recovered} = 500'), ['Belgium'])
+
+    def test_text_filters(self):
+        self.assertEqual(self.countries(filter_query='{Country} contains "Isle "'), ['Isle of Man'])
+        self.assertEqual(self.countries(filter_query='{Country} = Chad'), ['Chad'])
+
+    def test_missing_values_sort_last(self):
+        ascending = [{'column_id': 'Recovered', 'direction': 'asc'}]
+        descending = [{'column_id': 'Recovered', 'direction': 'desc'}]
+        self.assertEqual(self.countries(ascending), ['Belgium', 'Denmark', 'Albania', 'Isle of Man', 'Chad'])
+        self.assertEqual(self.countries(descending), ['Albania', 'Denmark', 'Belgium', 'Isle of Man', 'Chad'])
+
+    def test_paging(self):
+        records, page_count = self.index.page(1, 2, [{'column_id': 'Country', 'direction': 'asc'}], '')
+        self.assertEqual([record['Country'] for record in records], ['Chad', 'Denmark'])
+        self.assertEqual(page_count, 3)
+
+
+class DeathRateRankingTest(unittest.TestCase):
+    def setUp(self):
+        dates = pd.to_datetime(['2020-03-01', '2020-03-02', '2020-03-04'])
+        ts_df = pd.DataFrame({
+            'Date': dates.repeat(2),
+            'Country': ['Italy', 'Spain'] * 3,
+            'Confirmed': [100, 100, 200, 100, 400, 100],
+            'Recovered': [0, 0, 0, 0, 0, 0],
+            'Deaths': [10, 1, 10, 2, 10, 4],
+        })
+        headline_df = ts_df.groupby('Date', as_index=False)[['Confirmed', 'Recovered', 'Deaths']].sum()
+        self.ranking = helpers.DeathRateRanking(helpers.DailyAggregates(headline_df, ts_df))
+
+    def rates(self, date=None):
+        ranked = self.ranking.rank(date, min_cases=0, min_deaths=0)
+        return dict(zip(ranked['Country'], ranked['Rate']))
+
+    def test_dates_in_the_data(self):
+        self.assertEqual(self.rates('2020-03-01'), {'Italy': 0.1, 'Average': 11 / 200, 'Spain': 0.01})
+        self.assertEqual(self.rates(), self.rates('2020-03-04'))
+
+    def test_dates_between_and_after_the_data(self):
+        self.assertEqual(self.rates('2020-03-03'), self.rates('2020-03-02'))
+        self.assertEqual(self.rates('2020-06-01'), self.rates('2020-03-04'))
+
+    def test_dates_before_the_data(self):
+        with self.assertRaises(ValueError):
+            self.ranking.rank('2020-02-29')
+
+
+class DecimationTest(unittest.TestCase):
+    def test_max_points_for_width(self):
+        self.assertEqual(helpers.max_points_for_width(10), helpers.MIN_POINTS)
+        self.assertEqual(helpers.max_points_for_width(1000), 1024)
+        self.assertEqual(helpers.max_points_for_width(1024), 1024)
+        self.assertEqual(helpers.max_points_for_width(10 ** 6), helpers.MAX_POINTS)
+
+    def test_lttb_keeps_the_shape(self):
+        x = pd.date_range('2020-01-22', periods=1000)
+        y = np.sin(np.arange(1000) / 50.0)
+        y[500] = 10
+        keep = helpers.lttb(x, y, 100)
+        self.assertEqual(len(keep), 100)
+        self.assertEqual((keep[0], keep[-1]), (0, 999))
+        self.assertTrue((np.diff(keep) > 0).all())
+        # A spike is always the largest triangle in its bucket
+        self.assertIn(500, keep)
+
+    def test_lttb_short_series(self):
+        self.assertEqual(list(helpers.lttb(range(5), range(5), 10)), [0, 1, 2, 3, 4])
+        self.assertEqual(list(helpers.lttb(range(5), range(5), 2)), [0, 1, 2, 3, 4])
+
+    def test_decimate_range(self):
+        x = pd.date_range('2020-01-22', periods=100)
+        indices = helpers.decimate(x, np.arange(100), x_range=['2020-02-01', '2020-02-10'])
+        self.assertEqual(list(indices), list(range(10, 20)))
+        indices = helpers.decimate(x, np.arange(100), max_points=10, x_range=['2020-02-01', '2020-03-31'])
+        self.assertEqual(len(indices), 10)
+        self.assertEqual((indices[0], indices[-1]), (10, 69))
+
+
+class ZoomRangeTest(unittest.TestCase):
+    def test_zoom_on_dates(self):
+        self.assertEqual(
+            helpers.zoom_range({'xaxis.range[0]': '2020-03-10 12:00', 'xaxis.range[1]': '2020-03-20 12:00'}, dates=True),
+            (True, ['2020-02-29', '2020-03-31'])
+        )
+
+    def test_zoom_on_numbers(self):
+        self.assertEqual(helpers.zoom_range({'xaxis.range': [10.5, 20.5]}), (True, [0, 31]))
+
+    def test_zoom_out(self):
+        self.assertEqual(helpers.zoom_range({'xaxis.autorange': True}), (True, None))
+        self.assertEqual(helpers.zoom_range(None), (True, None))
+
+    def test_other_relayouts(self):
+        self.assertEqual(helpers.zoom_range({'autosize': True}), (False, None))
+        self.assertEqual(helpers.zoom_range({'yaxis.range[0]': 0, 'yaxis.range[1]': 5}), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
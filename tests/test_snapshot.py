@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import snapshot
+from dataset import Dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fixtures import FILES, generate_frames
+
+DAYS = 30
+ADDED_DAYS = 3
+
+
+def as_objects(df):
+    # Categories can be in a different order after an append, compare the values
+    return df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+
+
+class AppendSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.site = os.path.join(self.tmp.name, 'site')
+        self.url = os.path.join(self.site, 'datapackage.json')
+        self.frames = generate_frames(days=DAYS + ADDED_DAYS)
+        self.dates = sorted(self.frames['worldwide-aggregate']['Date'])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, days, frames=None):
+        # Write the resources with the first days of data, like upstream had them then
+        os.makedirs(self.site, exist_ok=True)
+        last = self.dates[days - 1]
+        resources = []
+        for name, df in (frames or self.frames).items():
+            if 'Date' in df:
+                df = df[df['Date'] <= last]
+            path = os.path.join(self.site, FILES[name])
+            if path.endswith('.json'):
+                df.to_json(path, orient='records')
+            else:
+                df.to_csv(path, index=False)
+            resources.append({'name': name, 'path': path})
+        with open(self.url, 'w') as f:
+            json.dump({'resources': resources}, f)
+
+    def snapshot_dir(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_append_matches_full_build(self):
+        self.write(DAYS)
+        old_frames, old_meta = snapshot.build_snapshot(self.url, self.snapshot_dir('appended'))
+        self.write(DAYS + ADDED_DAYS)
+
+        frames, meta = snapshot.append_snapshot(self.url, self.snapshot_dir('appended'))
+        full, _ = snapshot.build_snapshot(self.url, self.snapshot_dir('full'))
+
+        self.assertEqual(meta['previous'], old_meta['version'])
+        self.assertEqual(meta['appended']['headline_df'], ADDED_DAYS)
+        for name in full:
+            pd.testing.assert_frame_equal(as_objects(frames[name]), as_objects(full[name]), check_dtype=False)
+
+        # The previous version shares its column files, but still only has its own rows
+        previous, _ = snapshot.load_snapshot(self.snapshot_dir('appended'), old_meta)
+        for name in old_frames:
+            pd.testing.assert_frame_equal(as_objects(previous[name]), as_objects(old_frames[name]))
+
+    def test_dataset_extends_aggregates(self):
+        self.write(DAYS)
+        previous = Dataset(*snapshot.build_snapshot(self.url, self.snapshot_dir('appended')))
+        self.write(DAYS + ADDED_DAYS)
+
+        extended = Dataset(*snapshot.append_snapshot(self.url, self.snapshot_dir('appended')), previous=previous)
+        full = Dataset(*snapshot.build_snapshot(self.url, self.snapshot_dir('full')))
+
+        for got, expected in ((extended.aggregates.world, full.aggregates.world), (extended.aggregates.countries, full.aggregates.countries)):
+            self.assertEqual(list(got.columns), list(expected.columns))
+            self.assertTrue(got.index.equals(expected.index))
+            np.testing.assert_allclose(got.to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-9, equal_nan=True)
+        self.assertEqual(extended.current_confirmed, full.current_confirmed)
+        pd.testing.assert_frame_equal(extended.death_rates.rank(), full.death_rates.rank())
+
+    def test_backfilled_rows_rebuild(self):
+        # A row added upstream before the snapshot's last date can't be appended
+        revised = dict(self.frames)
+        revised['countries-aggregated'] = revised['countries-aggregated'].iloc[1:]
+        self.write(DAYS, revised)
+        snapshot.build_snapshot(self.url, self.snapshot_dir('appended'))
+        self.write(DAYS + ADDED_DAYS)
+
+        frames, meta = snapshot.append_snapshot(self.url, self.snapshot_dir('appended'))
+        self.assertNotIn('previous', meta)
+        self.assertEqual(len(frames['ts_df']), len(self.frames['countries-aggregated']))
+
+
+if __name__ == '__main__':
+    unittest.main()